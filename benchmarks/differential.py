@@ -0,0 +1,323 @@
+import argparse
+import datetime
+import math
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from benchmarks import reference_processor
+from benchmarks.run_benchmarks import history_file, DEFAULT_DATA_DIR
+from data_processor import process_dispatch_data, RESULT_COLUMNS, EARTH_RADIUS_KM, _clean_cache_lock
+from parallel import process_dispatch_files
+from pipeline import Pipeline
+from result_cache import ResultCache
+from scan_store import ScanStore
+from schema import read_history
+from sql_engine import process_dispatch_sql, HAS_DUCKDB
+from streaming import process_dispatch_file, SAMPLE_ROWS
+from validation import quality_frame, merge_checks
+
+SERVICES = ['Next Day', 'Same Day', 'Montreal']
+MISMATCH_COLUMNS = ['Mismatch_Route', 'Mismatch_Count', 'Amount_to_be_paid']
+
+def split_on_items(df, parts=2, overlap=0.2):
+    # Overlapping slices cut where Item_ID changes, so repeated rows of one
+    # item never straddle a cut; the parallel engine must drop the overlap
+    size = len(df)
+    bounds = []
+    for part in range(parts):
+        start = int(size * max(part / parts - overlap, 0)) if part else 0
+        end = int(size * min((part + 1) / parts, 1))
+        bounds.append((_item_boundary(df, start), _item_boundary(df, end)))
+    return [df.iloc[start:end] for start, end in bounds]
+
+def _item_boundary(df, position):
+    items = df['Item ID'].to_numpy()
+    while 0 < position < len(items) and items[position] == items[position - 1]:
+        position += 1
+    return position
+
+def mixed_item_ids(path, output_path):
+    # Shuffled rows with one late non-numeric Item ID: chunks and split files
+    # that infer their own types would see 123 in one and '123' in another
+    df = pd.read_csv(path).sample(frac=1, random_state=0).reset_index(drop=True)
+    df['Item ID'] = df['Item ID'].astype(object)
+    df.loc[int(len(df) * 0.9), 'Item ID'] = 'X999'
+    df.to_csv(output_path, index=False)
+    return output_path
+
+def numeric_address_parts(path, output_path):
+    # Bare unit numbers in Ship To Address 2, blank only in the last quarter of
+    # the rows: a chunk or split file inferring its own types reads 12 before
+    # the blanks and 12.0 after them, two keys for one address
+    df = pd.read_csv(path)
+    df['Ship To Address 2'] = (df['Item ID'] % 29 + 1).astype(object)
+    late = np.arange(len(df)) >= max(int(len(df) * 0.75), SAMPLE_ROWS)
+    df.loc[late & (df['Item ID'] % 7 == 0), 'Ship To Address 2'] = np.nan
+    df.to_csv(output_path, index=False)
+    return output_path
+
+def engines(path, workdir):
+    yield 'memory', lambda: process_dispatch_data(read_history(path))
+    yield 'memory (full read_csv)', lambda: process_dispatch_data(pd.read_csv(path))
+    yield 'pipeline', lambda: Pipeline(ResultCache()).run(path, lambda: read_history(path))
+    yield 'streaming', lambda: process_dispatch_file(path, memory_limit=4 * 1024 * 1024)
+    yield 'sql (sqlite)', lambda: process_dispatch_sql(path, backend='sqlite', memory_limit=4 * 1024 * 1024)
+    if HAS_DUCKDB:
+        yield 'sql (duckdb)', lambda: process_dispatch_sql(path, backend='duckdb', memory_limit=64 * 1024 * 1024)
+    yield 'parallel', lambda: process_dispatch_files(split_exports(path, workdir), workers=2)
+    yield 'parallel (busy thread)', lambda: parallel_while_busy(split_exports(path, workdir))
+
+def split_exports(path, workdir):
+    # Overlapping exports of one file with its text as exported, so each part
+    # infers what it would on its own: a unit number blank only in the later
+    # part reads as 12 in one export and 12.0 in the other
+    paths = []
+    for index, part in enumerate(split_on_items(pd.read_csv(path, dtype=str, keep_default_na=False))):
+        paths.append(os.path.join(workdir, f"part{index}.csv"))
+        part.to_csv(paths[-1], index=False)
+    return paths
+
+def parallel_while_busy(paths, hold_s=1, timeout_s=300):
+    # Workers start while another thread holds the clean-text memo lock, as a
+    # concurrent report job would; a forked worker would wait on it forever
+    holding = threading.Event()
+
+    def busy():
+        with _clean_cache_lock:
+            holding.set()
+            time.sleep(hold_s)
+    threading.Thread(target=busy, daemon=True).start()
+    holding.wait()
+
+    result = []
+
+    def run():
+        try:
+            result.append(process_dispatch_files(paths, workers=2))
+        except Exception as e:
+            result.append(e)
+    worker = threading.Thread(target=run, daemon=True)
+    worker.start()
+    worker.join(timeout_s)
+    if not result:
+        raise TimeoutError(f"The parallel engine did not finish within {timeout_s}s")
+    if isinstance(result[0], Exception):
+        raise result[0]
+    return result[0]
+
+def store_engine(path, workdir):
+    return ScanStore(os.path.join(workdir, 'store')).ingest_and_report([read_history(path)])
+
+def overlapping_store_engine(path, workdir):
+    # Scans shared by the exports must get the same event in each to be stored once
+    frames = [read_history(part) for part in split_exports(path, workdir)]
+    return ScanStore(os.path.join(workdir, 'store_overlapping')).ingest_and_report(frames)
+
+def reference_timeline(df):
+    # Plain row-by-row walk: each item's last OFD and delivered scan of a day,
+    # the later row on equal timestamps
+    last = {}
+    for item, scanned, status, route, driver in zip(
+            df['Item ID'], pd.to_datetime(df['ScanCode DateTime (MM/DD/YYYY HH:mm:ss)']),
+            df['Status'].map(reference_processor.categorize_status), df['Route Code'], df['Delivery Driver Name']):
+        if status not in ('OFD Scans', 'Delivered') or pd.isna(item) or pd.isna(scanned) \
+                or pd.isna(route) or pd.isna(driver):
+            continue
+        key = (status, item, scanned.date())
+        if key not in last or scanned >= last[key][0]:
+            last[key] = (scanned, route, driver)
+    return last
+
+def reference_mismatches(df):
+    # Mismatches: the same driver delivered the item under another route than its last OFD
+    last = reference_timeline(df)
+    mismatches = {}
+    for (status, item, date), (_, route, driver) in last.items():
+        delivered = last.get(('Delivered', item, date))
+        if status == 'OFD Scans' and delivered and delivered[1] != route and delivered[2] == driver:
+            routes, count = mismatches.get((date, driver, route), (set(), 0))
+            mismatches[(date, driver, route)] = (routes | {delivered[1]}, count + 1)
+    return mismatches
+
+def reference_lifecycle(df):
+    # Per item and day: OFD attempts and first OFD time over all its OFD scans,
+    # the last located OFD and delivery, and whether a located return exists;
+    # then per route of the last OFD scan
+    last = reference_timeline(df)
+    attempts, first_ofd, returned = {}, {}, set()
+    for item, scanned, status, route, driver in zip(
+            df['Item ID'], pd.to_datetime(df['ScanCode DateTime (MM/DD/YYYY HH:mm:ss)']),
+            df['Status'].map(reference_processor.categorize_status), df['Route Code'], df['Delivery Driver Name']):
+        if pd.isna(item) or pd.isna(scanned):
+            continue
+        key = (item, scanned.date())
+        if status == 'OFD Scans':
+            attempts[key] = attempts.get(key, 0) + 1
+            first_ofd[key] = min(first_ofd.get(key, scanned), scanned)
+        elif status == 'Return' and not (pd.isna(route) or pd.isna(driver)):
+            returned.add(key)
+
+    routes = {}
+    for (status, item, date), (_, route, driver) in last.items():
+        if status != 'OFD Scans':
+            continue
+        delivered = last.get(('Delivered', item, date))
+        latency = (delivered[0] - first_ofd[(item, date)]).total_seconds() / 60 if delivered else math.nan
+        routes.setdefault((date, driver, route), []).append(
+            (attempts[(item, date)], delivered is not None, (item, date) in returned, latency))
+
+    rows = []
+    for (date, driver, route), items in sorted(routes.items()):
+        latencies = [latency for *_, latency in items if latency >= 0]
+        rows.append({
+            'Date': date, 'Delivery_Driver_Name': driver, 'Route_Code': route, 'Items': len(items),
+            'Attempts_per_Item': sum(item[0] for item in items) / len(items),
+            'Delivered': sum(item[1] for item in items), 'Returned': sum(item[2] for item in items),
+            'Median_Delivery_Minutes': float(np.median(latencies)) if latencies else math.nan,
+            'Max_Delivery_Minutes': max(latencies) if latencies else math.nan,
+        })
+    frame = pd.DataFrame(rows)
+    frame['Delivery_Rate'] = frame['Delivered'] / frame['Items']
+    return frame
+
+def reference_distances(df):
+    # Each route's delivered positions sorted by time, then position, and the
+    # great-circle legs between consecutive distinct ones added up one by one
+    stops = {}
+    for scanned, status, date_route, latitude, longitude in zip(
+            pd.to_datetime(df['ScanCode DateTime (MM/DD/YYYY HH:mm:ss)']),
+            df['Status'].map(reference_processor.categorize_status),
+            zip(df['Route Code'], df['Delivery Driver Name']), df['Latitude'], df['Longitude']):
+        route, driver = date_route
+        if status != 'Delivered' or pd.isna(scanned) or pd.isna(route) or pd.isna(driver) \
+                or not (-90 <= latitude <= 90 and -180 <= longitude <= 180) or (latitude == 0 and longitude == 0):
+            continue
+        stops.setdefault((scanned.date(), driver, route), set()).add((scanned, latitude, longitude))
+    distances = {}
+    for key, points in stops.items():
+        points = sorted(points)
+        distances[key] = sum(_haversine_km(a[1], a[2], b[1], b[2]) for a, b in zip(points, points[1:]))
+    return distances
+
+def _haversine_km(latitude1, longitude1, latitude2, longitude2):
+    latitude1, longitude1, latitude2, longitude2 = map(math.radians, (latitude1, longitude1, latitude2, longitude2))
+    a = (math.sin((latitude2 - latitude1) / 2) ** 2
+         + math.cos(latitude1) * math.cos(latitude2) * math.sin((longitude2 - longitude1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+def reference_report(df):
+    # The original joined mismatches on (Date, Driver) only and repeated a route
+    # once per mismatch group; without the mismatch columns its rows collapse
+    # back to one per route. Mismatches come from reference_mismatches.
+    mismatches = reference_mismatches(df)
+    distances = reference_distances(df)
+    frames = []
+    for frame in reference_processor.process_dispatch_data(df.copy()):
+        frame = frame.drop(columns=MISMATCH_COLUMNS).drop_duplicates().reset_index(drop=True)
+        keys = list(zip(frame['Date'], frame['Delivery_Driver_Name'], frame['Route_Code']))
+        found = [mismatches.get(key, (None, 0)) for key in keys]
+        frame['Mismatch_Route'] = np.array([', '.join(sorted(routes)) if routes else np.nan for routes, _ in found],
+                                           dtype=object)
+        frame['Mismatch_Count'] = np.array([count for _, count in found], dtype=np.int64)
+        frame['Amount_to_be_paid'] = (frame['Delivered_No'] + frame['Mismatch_Count']) * frame['Rates']
+        frame['Distance_km'] = np.array([distances.get(key, 0.0) for key in keys], dtype=float)
+        frame['Packages_per_km'] = frame['Number_of_Packages'] / frame['Distance_km'].where(frame['Distance_km'] > 0)
+        hours = np.array([(datetime.datetime.combine(date, end) - datetime.datetime.combine(date, start)).total_seconds()
+                          / 3600 for date, start, end in zip(frame['Date'], frame['Start_Time'], frame['End_Time'])])
+        frame['Deliveries_per_hour'] = frame['Delivered_No'] / np.where(hours > 0, hours, np.nan)
+        frames.append(frame[RESULT_COLUMNS])
+    return frames
+
+def compare(expected, actual):
+    errors = []
+    for service, left, right in zip(SERVICES, expected, actual):
+        try:
+            pd.testing.assert_frame_equal(left.reset_index(drop=True), right.reset_index(drop=True)[left.columns])
+        except (AssertionError, KeyError) as e:
+            errors.append(f"{service}: {e}")
+    return errors
+
+def run(path):
+    expected = reference_report(pd.read_csv(path))
+    # The store keeps each scan event once, so it is compared with the
+    # reference run on the deduplicated export
+    deduplicated = reference_report(pd.read_csv(path).drop_duplicates())
+
+    failures = 0
+    with tempfile.TemporaryDirectory() as workdir:
+        checks = [(name, run_engine, expected) for name, run_engine in engines(path, workdir)]
+        checks.append(('store', lambda: store_engine(path, workdir), deduplicated))
+        checks.append(('store (overlapping exports)', lambda: overlapping_store_engine(path, workdir), deduplicated))
+
+        for name, run_engine, reference in checks:
+            errors = compare(reference, run_engine())
+            failures += bool(errors)
+            print(f"{'FAIL' if errors else 'ok':<5} {name}")
+            for error in errors:
+                print('      ' + error.replace('\n', '\n      '))
+
+        # Lifecycle KPIs come from the stage chain's partials, checked against a row walk
+        pipeline = Pipeline(ResultCache())
+        kpis, quality = pipeline.run(path, lambda: read_history(path), ['lifecycle', 'quality'])
+        checks = [('lifecycle', lambda: kpis, reference_lifecycle(pd.read_csv(path)))]
+        # Row-quality counts merged from chunks or files match the whole-file report
+        for name, run_engine in quality_engines(path, workdir):
+            checks.append((f"quality ({name})", run_engine, quality))
+        for name, run_engine, reference in checks:
+            try:
+                pd.testing.assert_frame_equal(reference, run_engine(), check_dtype=False)
+                errors = []
+            except AssertionError as e:
+                errors = [str(e)]
+            failures += bool(errors)
+            print(f"{'FAIL' if errors else 'ok':<5} {name}")
+            for error in errors:
+                print('      ' + error.replace('\n', '\n      '))
+    return failures
+
+def quality_engines(path, workdir):
+    def merged(process):
+        def run_engine():
+            checks = []
+            process(checks)
+            return quality_frame(merge_checks(checks))
+        return run_engine
+    yield 'streaming', merged(lambda checks: process_dispatch_file(path, memory_limit=4 * 1024 * 1024, quality=checks))
+    yield 'sql', merged(lambda checks: process_dispatch_sql(path, backend='sqlite', memory_limit=4 * 1024 * 1024,
+                                                            quality=checks))
+    yield 'parallel', merged(lambda checks: process_dispatch_files([path], workers=1, quality=checks))
+    # Scans shared by overlapping exports are counted once, as in the whole file
+    yield 'parallel, overlapping exports', merged(
+        lambda checks: process_dispatch_files(split_exports(path, workdir), workers=1, quality=checks))
+    yield 'store, overlapping exports', merged(lambda checks: ScanStore(os.path.join(workdir, 'quality_store'))
+                                               .ingest_and_report([read_history(part)
+                                                                   for part in split_exports(path, workdir)], checks))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check every engine against the frozen reference implementation.")
+    parser.add_argument('--rows', default='2000,20000', help="Comma-separated synthetic sizes; the reference is slow")
+    parser.add_argument('--input', action='append', default=[], help="Check a real History file as well")
+    parser.add_argument('--data-dir', default=DEFAULT_DATA_DIR)
+    args = parser.parse_args(argv)
+
+    failures = 0
+    paths = [history_file(int(rows), args.data_dir) for rows in filter(None, args.rows.split(','))] + args.input
+    with tempfile.TemporaryDirectory() as workdir:
+        if paths:
+            paths.append(mixed_item_ids(paths[0], os.path.join(workdir, 'mixed_item_ids.csv')))
+        # Needs more rows than the first streamed chunk
+        paths.append(numeric_address_parts(history_file(2 * SAMPLE_ROWS, args.data_dir),
+                                           os.path.join(workdir, 'numeric_address_parts.csv')))
+        for path in paths:
+            print(path)
+            failures += run(path)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,196 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from dispatch_rules import load_rules
+
+# Raw export header in the order of the real History CSV, plus columns the
+# report never reads so projection is exercised too.
+HEADER = ['Item ID', 'Bill To Account Number', 'Tracking Number', 'Service',
+          'ScanCode DateTime (MM/DD/YYYY HH:mm:ss)', 'Status', 'Status Description', 'Route Code',
+          'Ship To Name', 'Ship To Address', 'Ship To Address 2', 'Ship To City', 'Ship To State/Province',
+          'Ship To Postal Code/ZIP', 'Ship To Country', 'Delivery Driver Name', 'Delivery Address',
+          'Delivery City', 'Delivery Province', 'Delivery Postal Code/ZIP', 'Delivery Country',
+          'Latitude', 'Longitude', 'Client Name', 'Weight', 'Pieces', 'Reference 1']
+
+# City spellings as they show up in exports, with their centre coordinates
+CITIES = [
+    ('Toronto', 'ON', 43.65, -79.38), ('TORONTO', 'ON', 43.65, -79.38), ('Mississauga', 'ON', 43.59, -79.64),
+    ('mississauga ', 'ON', 43.59, -79.64), ('Oakville', 'ON', 43.47, -79.69), ('oakville!', 'ON', 43.47, -79.69),
+    ('Burlington', 'ON', 43.33, -79.80), ('Brampton', 'ON', 43.73, -79.76), ('Montréal', 'QC', 45.50, -73.57),
+    ('Laval', 'QC', 45.57, -73.69),
+]
+STREETS = ['Main St.', 'King St W', 'Queen St. E', 'Dundas St', 'Bloor St W', 'Lakeshore Rd', 'Rue Sainte-Catherine',
+           'Yonge St.', 'Bathurst St', 'Avenue Rd']
+CLIENTS = ['Zara', 'Simons', 'Indigo', 'Aritzia', 'Lululemon']
+SERVICES = ['Standard', 'Express', 'Same Day']
+
+DEFAULT_STATUS_MIX = {'delivered': 0.86, 'return': 0.08, 'exception': 0.02, 'other': 0.04}
+
+def parse_status_mix(text):
+    mix = dict(DEFAULT_STATUS_MIX)
+    for part in filter(None, text.split(',')):
+        name, value = part.split('=')
+        mix[name.strip()] = float(value)
+    total = sum(mix.values())
+    return {name: value / total for name, value in mix.items()}
+
+def status_codes():
+    statuses = load_rules().config['statuses']
+    return {
+        'ofd': statuses['OFD Scans'],
+        'delivered': statuses['Delivered'],
+        'return': statuses['Return'],
+        'exception': statuses['Lost in Transit'] + statuses['AJTM'] + statuses['Pickup'],
+        # Codes no rule knows about land in "Other"
+        'other': ['HLD_WAREHOUSE', 'CUSTOMS_HOLD', 'INFO_RECEIVED'],
+    }
+
+def route_codes(routes, same_day_share=0.15, montreal_share=0.2):
+    same_day = max(1, int(routes * same_day_share))
+    montreal = max(1, int(routes * montreal_share))
+    next_day = max(1, routes - same_day - montreal)
+    return ([f"YYZ-R{i:03d}" for i in range(next_day)] + [f"YYZ-SD{i:02d}" for i in range(same_day)]
+            + [f"YUL-M{i:02d}" for i in range(montreal)])
+
+def generate_chunk(rng, items, first_item, options):
+    codes = options['codes']
+    routes = options['routes']
+    n_drivers = options['drivers']
+    start = pd.Timestamp(options['start'])
+
+    # Each driver owns a home route; reroutes deliver on the driver's next route
+    driver = rng.integers(0, n_drivers, items)
+    route = driver % len(routes)
+    day = rng.integers(0, options['days'], items)
+    city = rng.integers(0, len(CITIES), items)
+    item_id = np.arange(first_item, first_item + items)
+
+    outcome = rng.choice(list(options['status_mix']), size=items, p=list(options['status_mix'].values()))
+    second_attempt = rng.random(items) < options['attempt_rate']
+    rerouted = (outcome == 'delivered') & (rng.random(items) < options['reroute_rate'])
+
+    # Event layout per item: scansort, OFD, optional second OFD, outcome
+    events_per_item = 3 + second_attempt
+    event_item = np.repeat(np.arange(items), events_per_item)
+    event_index = np.arange(len(event_item)) - np.repeat(np.cumsum(events_per_item) - events_per_item, events_per_item)
+    is_outcome = event_index == events_per_item[event_item] - 1
+    is_ofd = ~is_outcome & (event_index >= 1)
+
+    status = np.full(len(event_item), 'SCANSORT', dtype=object)
+    status[is_ofd] = rng.choice(codes['ofd'], size=is_ofd.sum(), p=ofd_weights(codes['ofd']))
+    outcome_of = outcome[event_item[is_outcome]]
+    outcome_status = np.empty(len(outcome_of), dtype=object)
+    for name in options['status_mix']:
+        mask = outcome_of == name
+        outcome_status[mask] = rng.choice(codes[name], size=mask.sum())
+    status[is_outcome] = outcome_status
+
+    event_route = route[event_item]
+    reroute = is_outcome & rerouted[event_item]
+    event_route[reroute] = (event_route[reroute] + 1) % len(routes)
+
+    # Scansort before 7:00, OFD 7:00-10:00, outcomes through the day
+    seconds = np.where(event_index == 0, rng.integers(4 * 3600, 7 * 3600, len(event_item)),
+                       np.where(is_ofd, rng.integers(7 * 3600, 10 * 3600, len(event_item)),
+                                rng.integers(10 * 3600, 21 * 3600, len(event_item))))
+    scan_time = start + pd.to_timedelta(day[event_item], unit='D') + pd.to_timedelta(seconds, unit='s')
+
+    event_city = city[event_item]
+    latitude = np.array([c[2] for c in CITIES])[event_city] + rng.normal(0, 0.03, len(event_item))
+    longitude = np.array([c[3] for c in CITIES])[event_city] + rng.normal(0, 0.03, len(event_item))
+    city_names = np.array([c[0] for c in CITIES], dtype=object)[event_city]
+    provinces = np.array([c[1] for c in CITIES], dtype=object)[event_city]
+    house = rng.integers(1, 400, items)[event_item]
+    street = np.array(STREETS, dtype=object)[rng.integers(0, len(STREETS), items)][event_item]
+    addresses = pd.Series(house).astype(str).to_numpy(dtype=object) + ' ' + street
+    unit = np.where(rng.random(items) < 0.2, 'Unit #' + pd.Series(rng.integers(1, 30, items)).astype(str), '')[event_item]
+
+    df = pd.DataFrame({
+        'Item ID': item_id[event_item],
+        'Bill To Account Number': rng.integers(1000, 1010, items)[event_item],
+        'Tracking Number': pd.Series(item_id[event_item]).map('ECM{:010d}'.format).to_numpy(),
+        'Service': np.array(SERVICES, dtype=object)[rng.integers(0, len(SERVICES), items)][event_item],
+        'ScanCode DateTime (MM/DD/YYYY HH:mm:ss)': scan_time.strftime('%m/%d/%Y %H:%M:%S'),
+        'Status': status,
+        'Status Description': status,
+        'Route Code': np.array(routes, dtype=object)[event_route],
+        'Ship To Name': 'Customer ' + pd.Series(item_id[event_item] % 5000).astype(str).to_numpy(dtype=object),
+        'Ship To Address': addresses,
+        'Ship To Address 2': unit,
+        'Ship To City': city_names,
+        'Ship To State/Province': provinces,
+        'Ship To Postal Code/ZIP': np.where(provinces == 'QC', 'H2X 1Y4', 'M5V 2T6'),
+        'Ship To Country': 'CA',
+        'Delivery Driver Name': np.array([f"Driver {i:04d}" for i in range(n_drivers)], dtype=object)[driver[event_item]],
+        'Delivery Address': addresses,
+        'Delivery City': city_names,
+        'Delivery Province': provinces,
+        'Delivery Postal Code/ZIP': np.where(provinces == 'QC', 'H2X 1Y4', 'M5V 2T6'),
+        'Delivery Country': 'CA',
+        'Latitude': latitude.round(6),
+        'Longitude': longitude.round(6),
+        'Client Name': np.array(CLIENTS, dtype=object)[item_id[event_item] % len(CLIENTS)],
+        'Weight': rng.random(len(event_item)).round(2),
+        'Pieces': 1,
+        'Reference 1': '',
+    }, columns=HEADER)
+
+    # Exports repeat some scan rows verbatim
+    duplicates = rng.random(len(df)) < options['duplicate_rate']
+    if duplicates.any():
+        df = pd.concat([df, df[duplicates]]).sort_index(kind='stable')
+    return df
+
+def ofd_weights(ofd_codes):
+    weights = np.array([8.0] + [1.0] * (len(ofd_codes) - 1))
+    return weights / weights.sum()
+
+def generate_history(path, rows, drivers=60, routes=40, days=3, status_mix=None, reroute_rate=0.03,
+                     attempt_rate=0.05, duplicate_rate=0.01, start='2025-03-10', seed=0, chunk_rows=500_000):
+    # Written in chunks of whole items so 10M-row files need little memory
+    rng = np.random.default_rng(seed)
+    options = {
+        'codes': status_codes(),
+        'routes': route_codes(routes),
+        'drivers': drivers,
+        'days': days,
+        'start': start,
+        'status_mix': status_mix or DEFAULT_STATUS_MIX,
+        'reroute_rate': reroute_rate,
+        'attempt_rate': attempt_rate,
+        'duplicate_rate': duplicate_rate,
+    }
+    rows_per_item = 3 + attempt_rate + 3 * duplicate_rate
+    total_items = max(1, int(rows / rows_per_item))
+    items_per_chunk = max(1, int(chunk_rows / rows_per_item))
+
+    written = 0
+    for first_item in range(0, total_items, items_per_chunk):
+        items = min(items_per_chunk, total_items - first_item)
+        chunk = generate_chunk(rng, items, 10_000_000 + first_item, options)
+        chunk.to_csv(path, mode='w' if first_item == 0 else 'a', header=first_item == 0, index=False)
+        written += len(chunk)
+    return written
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write a synthetic History export.")
+    parser.add_argument('path')
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--drivers', type=int, default=60)
+    parser.add_argument('--routes', type=int, default=40)
+    parser.add_argument('--days', type=int, default=3)
+    parser.add_argument('--status-mix', default='', help="e.g. delivered=0.8,return=0.1,exception=0.05,other=0.05")
+    parser.add_argument('--reroute-rate', type=float, default=0.03)
+    parser.add_argument('--attempt-rate', type=float, default=0.05)
+    parser.add_argument('--duplicate-rate', type=float, default=0.01)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    rows = generate_history(args.path, args.rows, drivers=args.drivers, routes=args.routes, days=args.days,
+                            status_mix=parse_status_mix(args.status_mix), reroute_rate=args.reroute_rate,
+                            attempt_rate=args.attempt_rate, duplicate_rate=args.duplicate_rate, seed=args.seed)
+    print(f"Wrote {rows} rows to {args.path}")
+
+if __name__ == '__main__':
+    main()
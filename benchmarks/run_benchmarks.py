@@ -0,0 +1,123 @@
+import argparse
+import json
+import os
+import time
+import tracemalloc
+
+from benchmarks.generate_history import generate_history
+from data_processor import (COLUMNS_TO_CLEAN, ADDRESS_COLUMNS, prepare_scans, clean_column, address_key,
+                            parse_scan_times, route_partials, aggregate_routes, count_mismatches, build_report,
+                            create_excel_report)
+from dispatch_rules import get_rules
+from schema import read_history, RENAMED_COLUMNS, SELECTED_COLUMNS
+
+DEFAULT_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+def history_file(rows, data_dir=DEFAULT_DATA_DIR, **options):
+    # Generated files are reused across runs with the same parameters
+    os.makedirs(data_dir, exist_ok=True)
+    suffix = ''.join(f"_{key}{value}" for key, value in sorted(options.items()))
+    path = os.path.join(data_dir, f"History_synthetic_{rows}{suffix}.csv")
+    if not os.path.exists(path):
+        generate_history(path, rows, **options)
+    return path
+
+def _measure(name, func, rows_in=None, memory=True):
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    result = func()
+    wall, cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+    stats = {'stage': name, 'wall_s': wall, 'cpu_s': cpu, 'rows_in': rows_in, 'rows_out': _rows(result),
+             'peak_mb': float('nan'), 'retained_mb': float('nan')}
+
+    # tracemalloc slows allocation-heavy code down a lot, so memory is
+    # measured in a second, traced run of the same stage
+    if memory:
+        tracemalloc.start()
+        traced = func()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del traced
+        stats.update(peak_mb=peak / 1e6, retained_mb=current / 1e6)
+    return result, stats
+
+def _rows(result):
+    if hasattr(result, '__len__') and not isinstance(result, (tuple, dict)):
+        return len(result)
+    if isinstance(result, tuple):
+        return sum(len(part) for part in result)
+    return None
+
+def _component_stages(df, measure):
+    # Component stages run on their own inputs so each is timed in isolation;
+    # their column frame is released before the full stages are traced
+    selected = df[SELECTED_COLUMNS].rename(columns=RENAMED_COLUMNS)
+    rows = len(selected)
+    stages = []
+    _, stats = measure('clean', lambda: [clean_column(selected[col]) for col in COLUMNS_TO_CLEAN], rows)
+    stages.append(stats)
+    _, stats = measure('address_key', lambda: address_key(selected[ADDRESS_COLUMNS]), rows)
+    stages.append(stats)
+    _, stats = measure('timestamps', lambda: parse_scan_times(selected['Scan_Date']), rows)
+    stages.append(stats)
+    _, stats = measure('classify', lambda: get_rules().categorize_statuses(selected['Status']), rows)
+    stages.append(stats)
+    return stages
+
+def benchmark_file(path, memory=True):
+    stages = []
+
+    def measure(name, func, rows_in=None):
+        return _measure(name, func, rows_in, memory)
+
+    df, stats = measure('parse', lambda: read_history(path))
+    stages.append(stats)
+    rows = len(df)
+
+    stages += _component_stages(df, measure)
+    df_selected, stats = measure('prepare', lambda: prepare_scans(df), rows)
+    stages.append(stats)
+    partials, stats = measure('partials', lambda: route_partials(df_selected), rows)
+    stages.append(stats)
+    _, stats = measure('aggregate', lambda: aggregate_routes(partials))
+    stages.append(stats)
+    _, stats = measure('mismatch', lambda: count_mismatches(partials))
+    stages.append(stats)
+    frames, stats = measure('report', lambda: build_report(partials))
+    stages.append(stats)
+    _, stats = measure('excel', lambda: create_excel_report(*frames), _rows(frames))
+    stages.append(stats)
+    return stages
+
+def print_stages(rows, stages):
+    print(f"\n{rows:,} rows")
+    print(f"{'stage':<12} {'wall s':>9} {'cpu s':>9} {'rows in':>11} {'rows out':>11} {'peak MB':>9} {'kept MB':>9}")
+    for s in stages:
+        print(f"{s['stage']:<12} {s['wall_s']:9.3f} {s['cpu_s']:9.3f} {s['rows_in'] or '':>11} "
+              f"{s['rows_out'] if s['rows_out'] is not None else '':>11} {s['peak_mb']:9.1f} {s['retained_mb']:9.1f}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time and memory-profile each stage of the dispatch pipeline.")
+    parser.add_argument('--rows', default='10000,100000,1000000', help="Comma-separated synthetic sizes")
+    parser.add_argument('--input', action='append', default=[], help="Benchmark a real History file as well")
+    parser.add_argument('--drivers', type=int, default=60)
+    parser.add_argument('--routes', type=int, default=40)
+    parser.add_argument('--data-dir', default=DEFAULT_DATA_DIR)
+    parser.add_argument('--no-memory', action='store_true', help="Skip the traced run that measures memory")
+    parser.add_argument('--json', help="Also write the results to this file")
+    args = parser.parse_args(argv)
+
+    results = []
+    paths = [history_file(int(rows), args.data_dir, drivers=args.drivers, routes=args.routes)
+             for rows in filter(None, args.rows.split(','))] + args.input
+    for path in paths:
+        stages = benchmark_file(path, memory=not args.no_memory)
+        rows = stages[0]['rows_out']
+        print_stages(rows, stages)
+        results.append({'input': path, 'rows': rows, 'stages': stages})
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
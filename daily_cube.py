@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from data_processor import RESULT_COLUMNS, split_services, create_excel_report
+from instrumentation import stage
+from scan_store import ScanStore
+from schema import HAS_PYARROW, read_parquet
+
+DEFAULT_CUBE_DIR = os.environ.get('DISPATCH_CUBE_DIR', 'dispatch_cube')
+
+# Period aliases of the rollups; 'all' totals the whole date range
+FREQUENCIES = {'day': 'D', 'week': 'W', 'month': 'M', 'all': None}
+
+PAYROLL_COLUMNS = ['Delivered_No', 'Mismatch_Count', 'Confirmed_Return', 'Amount_to_be_paid']
+ROLLUP_COLUMNS = ['Period_Start', 'Period_End', 'Delivery_Driver_Name', 'Service', 'Days', 'Routes'] + PAYROLL_COLUMNS
+
+# Text columns kept as categories in memory, so rollups group on codes
+CATEGORY_COLUMNS = ['Delivery_Driver_Name', 'Route_Code', 'Delivery_City', 'Service']
+
+class DailyCube:
+    # The finished report rows, one per (Date, Driver, Route, Service), kept
+    # in one Parquet file sorted by date. Payroll rollups over any date range
+    # slice the loaded rows by binary search instead of rereading History
+    # exports. Rows keep the rates they were paid at: a report replaces the
+    # cube's rows for every date it covers, earlier dates are left alone.
+    # Exports overlap by days, so reports are taken from a ScanStore, whose
+    # rows for a date include the scans of every export of that date.
+
+    def __init__(self, root=DEFAULT_CUBE_DIR):
+        if not HAS_PYARROW:
+            raise ImportError("The daily cube needs pyarrow: pip install pyarrow")
+        self.root = root
+        self.path = os.path.join(root, 'cube.parquet')
+        self._rows = None
+        self._mtime = None
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def store_dir(root):
+        # The scan store feeding a cube when no other store is given
+        return os.path.join(root, 'scans')
+
+    def ingest(self, frames, store=None):
+        # Raw History frames; returns the report of the dates they touched
+        report = (store or ScanStore(self.store_dir(self.root))).ingest_and_report(frames)
+        self.add_report(report)
+        return report
+
+    def dates(self):
+        return list(pd.DatetimeIndex(self._load()['Date'].unique()))
+
+    def add_report(self, frames):
+        # frames are the service sheets of a store report, complete for every
+        # date they hold; returns the dates replaced
+        report = pd.concat([frame[RESULT_COLUMNS] for frame in frames], ignore_index=True)
+        with stage('cube', len(report)):
+            report['Date'] = pd.to_datetime(report['Date'])
+            rows = self._load()
+            kept = rows[~rows['Date'].isin(report['Date'].unique())]
+            parts = [kept, report] if len(kept) else [report]
+            combined = pd.concat([_storage_types(part) for part in parts], ignore_index=True)
+            combined = combined.sort_values(['Date', 'Delivery_Driver_Name', 'Route_Code'], kind='stable')
+            tmp_path = self.path + '.tmp'
+            combined.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, self.path)
+            self._rows = None
+        return sorted(report['Date'].unique())
+
+    def rows(self, start=None, end=None, drivers=None, services=None):
+        # Report rows of the inclusive date range, optionally of some drivers or services
+        rows = self._load()
+        dates = rows['Date'].to_numpy()
+        first = 0 if start is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(start)), 'left')
+        last = len(dates) if end is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(end)), 'right')
+        rows = rows.iloc[first:last]
+        if drivers is not None:
+            rows = rows[rows['Delivery_Driver_Name'].isin(drivers)]
+        if services is not None:
+            rows = rows[rows['Service'].isin(services)]
+        return rows
+
+    def rollup(self, start=None, end=None, freq='week', drivers=None, services=None):
+        # Payroll totals per period, driver and service
+        with stage('rollup'):
+            rows = self.rows(start, end, drivers, services)
+            if FREQUENCIES[freq] is None:
+                period_start = pd.Series(pd.Timestamp(start) if start is not None else rows['Date'].min(), index=rows.index)
+                period_end = pd.Series(pd.Timestamp(end) if end is not None else rows['Date'].max(), index=rows.index)
+            else:
+                periods = rows['Date'].dt.to_period(FREQUENCIES[freq])
+                period_start = periods.dt.start_time
+                period_end = periods.dt.end_time.dt.normalize()
+            keyed = rows.assign(Period_Start=period_start, Period_End=period_end)
+            totals = keyed.groupby(['Period_Start', 'Period_End', 'Delivery_Driver_Name', 'Service'],
+                                   observed=True, sort=True).agg(
+                Days=('Date', 'nunique'), Routes=('Route_Code', 'size'),
+                **{column: (column, 'sum') for column in PAYROLL_COLUMNS}).reset_index()
+            totals['Period_Start'] = totals['Period_Start'].dt.date
+            totals['Period_End'] = totals['Period_End'].dt.date
+            for column in CATEGORY_COLUMNS:
+                if column in totals:
+                    totals[column] = totals[column].astype(object)
+            return totals[ROLLUP_COLUMNS]
+
+    def _load(self):
+        # Reread when another process has added a report since the last load
+        mtime = os.path.getmtime(self.path) if os.path.exists(self.path) else None
+        if self._rows is None or mtime != self._mtime:
+            if mtime is None:
+                rows = pd.DataFrame({column: pd.Series(dtype=object) for column in RESULT_COLUMNS})
+                rows['Date'] = pd.Series(dtype='datetime64[ns]')
+            else:
+                rows = read_parquet(self.path)
+                rows['Date'] = rows['Date'].astype('datetime64[ns]')
+            for column in CATEGORY_COLUMNS:
+                rows[column] = rows[column].astype('category')
+            self._rows, self._mtime = rows.reset_index(drop=True), mtime
+        return self._rows
+
+def _storage_types(rows):
+    # Text as plain objects, so reports with different categories concatenate
+    rows = rows.copy()
+    for column in CATEGORY_COLUMNS:
+        rows[column] = rows[column].astype(object)
+    return rows
+
+def report_frames(frame):
+    # Rollups and rows as the three service sheets of create_excel_report
+    if 'Date' in frame:
+        frame = frame.assign(Date=frame['Date'].dt.date)
+    return tuple(sheet.reset_index(drop=True) for sheet in split_services(frame))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Payroll totals from the daily cube of dispatch reports.")
+    parser.add_argument('--cube-dir', default=DEFAULT_CUBE_DIR, help="Directory dispatch_processor.py --cube-dir wrote to")
+    parser.add_argument('--start', help="First date, e.g. 2025-03-01")
+    parser.add_argument('--end', help="Last date, inclusive")
+    parser.add_argument('--freq', choices=FREQUENCIES, default='week', help="Period of the totals")
+    parser.add_argument('--driver', action='append', help="Only this driver; repeat for several")
+    parser.add_argument('--rows', action='store_true', help="Export the report rows instead of totals")
+    parser.add_argument('-o', '--output', default='payroll.xlsx', help="Workbook to write")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        cube = DailyCube(args.cube_dir)
+        if args.rows:
+            frame = cube.rows(args.start, args.end, args.driver)
+        else:
+            frame = cube.rollup(args.start, args.end, args.freq, args.driver)
+        with open(args.output, 'wb') as f:
+            f.write(create_excel_report(*report_frames(frame)).getvalue())
+    except (OSError, ValueError, ImportError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    print(args.output)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,18 @@
 
+import numpy as np
 import pandas as pd
 import re
+import threading
+from itertools import islice
 from datetime import datetime
 import warnings
 import io
 
+from schema import SELECTED_COLUMNS, RENAMED_COLUMNS, SCAN_TIME_FORMAT, normalize_columns, check_columns
+from dispatch_rules import get_rules
+from instrumentation import stage, instrumented
+from exports import write_xlsx
+
 # Suppress warnings
 warnings.filterwarnings('ignore')
 
@@ -16,183 +24,421 @@ def clean_text(text):
     return text
 
 def categorize_status(status):
-    delivered_statuses = ["DEL_VERBAL", "DEL_ASR", "DEL_SIG", "DEL_OSNR"]
-    ofd_scan_statuses = ["ITR_OFD", "FEDEX_ACCEPTED", "PIC_CANPAR", "PURO_ACCEPTED"]
-    return_statuses = ["EXC_BADADDRESS", "EXC_CONS_NA", "EXC_DMG", "EXC_MECHDELAY", "EXC_MISSING",
-                      "EXC_MISSORT", "EXC_NOACCESS", "EXC_NODELATTEMPT", "EXC_REC_NA", "EXC_RECCLOSED",
-                      "EXC_RECUNNDKL", "EXC_REFUSED", "EXC_UNSAFE", "EXC_WEATHER", "RET_PUR",
-                      "RET_TOR", "RET_WAR", "REC_TOR"]
-    scansort_statuses = ["SCANSORT"]
-    manifested_statuses = ['1']
-    AJTM_statuses = ["AJTM"]
-    lost_in_transit_statuses = ["LOST_IN_TRANSIT"]
-    pickup_statuses = ["PU01"]
-
-    if status in delivered_statuses:
-        return "Delivered"
-    elif status in ofd_scan_statuses:
-        return "OFD Scans"
-    elif status in return_statuses:
-        return "Return"
-    elif status in scansort_statuses:
-        return "Scansort"
-    elif status in lost_in_transit_statuses:
-        return "Lost in Transit"
-    elif status in pickup_statuses:
-        return "Pickup"
-    elif status in AJTM_statuses:
-        return "AJTM"
-    elif status in manifested_statuses:
-        return "Manifested"
-    else:
-        return "Other"
+    return get_rules().status_of(status)
 
 def categorize_service(route_code):
-    if isinstance(route_code, str):
-        if route_code.startswith('YYZ-SD'):
-            return 'Same Day'
-        elif route_code.startswith('YYZ-'):
-            return 'Next Day'
-        elif route_code.startswith('YUL-'):
-            return 'Montreal'
-    return 'Other'
+    return get_rules().service_of(route_code)
 
 def calculate_rate(row):
-    service = row['Service']
-    city = row['Delivery_City']
-    if service == 'Next Day':
-        if city in ['Oakville', 'Burlington']:
-            return 2.45
-        else:
-            return 2.20
-    elif service == 'Same Day':
-        return 3.5
-    elif service == 'Montreal':
-        return 3
-    return 0.0
+    return get_rules().rate_of(row['Service'], row['Delivery_City'])
 
-def process_dispatch_data(df):
-    # Clean column names
-    df.columns = df.columns.str.replace(' ', '_')
+GROUP_KEYS = ['Date', 'Delivery_Driver_Name', 'Route_Code']
+
+# Bumped whenever the report's numbers change for the same input, so cached
+# reports from older code are not served
+REPORT_VERSION = 7
+
+RESULT_COLUMNS = ['Date', 'Delivery_Driver_Name', 'Route_Code', 'Number_of_Packages', 'Number_of_Stops',
+                  'Delivery_City', 'Service', 'Start_Time', 'End_Time', 'Delivered_No', 'Mismatch_Route',
+                  'Mismatch_Count', 'Confirmed_Return', 'Rates', 'Amount_to_be_paid',
+                  'Distance_km', 'Packages_per_km', 'Deliveries_per_hour']
+
+# Cleaned values are memoised across uploads, since exports repeat the same
+# cities and addresses millions of times. Oldest entries are evicted first.
+# Sessions and report jobs clean concurrently, so the memo is only touched
+# under its lock and each call works from its own lookup.
+CLEAN_CACHE_SIZE = 200_000
+_clean_cache = {}
+_clean_cache_lock = threading.Lock()
+
+def _clean_uniques(values):
+    strings = [value for value in values if isinstance(value, str)]
+    with _clean_cache_lock:
+        lookup = {value: _clean_cache[value] for value in strings if value in _clean_cache}
+    missing = [value for value in strings if value not in lookup]
+    if missing:
+        stripped = pd.Series(missing, dtype=object).str.replace(r"[^a-zA-Z0-9\s]", "", regex=True)
+        for value, text in zip(missing, stripped):
+            lookup[value] = ' '.join(word.capitalize() for word in text.split())
+
+    cleaned = np.array([lookup[value] if isinstance(value, str) else value for value in values], dtype=object)
+
+    if missing:
+        with _clean_cache_lock:
+            for value in missing:
+                _clean_cache[value] = lookup[value]
+            overflow = len(_clean_cache) - CLEAN_CACHE_SIZE
+            if overflow > 0:
+                for value in list(islice(_clean_cache, overflow)):
+                    del _clean_cache[value]
+    return cleaned
+
+def clean_column(series):
+    # Clean each distinct value once and broadcast it back through the codes
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        if len(series.cat.categories) == 0:
+            return series.copy()
+        cleaned = _clean_uniques(series.cat.categories)
+        new_codes, categories = pd.factorize(cleaned)
+        codes = series.cat.codes.to_numpy()
+        codes = np.where(codes >= 0, new_codes[codes], -1)
+        return pd.Series(pd.Categorical.from_codes(codes, categories), index=series.index, name=series.name)
+
+    # Only strings are cleaned, so numeric columns pass through untouched
+    if series.dtype != object:
+        return series.copy()
+    codes, uniques = pd.factorize(series)
+    if len(uniques) == 0:
+        return series.copy()
+    cleaned = _clean_uniques(uniques)
+    values = np.where(codes >= 0, cleaned[codes], series.to_numpy(dtype=object))
+    return pd.Series(values, index=series.index, name=series.name, dtype=object)
+
+COLUMNS_TO_CLEAN = ['Ship_To_Name', 'Ship_To_Address', 'Ship_To_Address_2', 'Ship_To_City',
+                    'Ship_To_State/Province', 'Ship_To_Postal_Code/ZIP', 'Ship_To_Country',
+                    'Delivery_City']
+
+ADDRESS_COLUMNS = ['Ship_To_Name', 'Ship_To_Address', 'Ship_To_Address_2', 'Ship_To_City',
+                   'Ship_To_State/Province', 'Ship_To_Postal_Code/ZIP', 'Ship_To_Country']
+
+def address_key(address_df):
+    # Hash the string form of each distinct part, as the old ', '-joined address
+    # did with astype(str), then combine the parts row-wise as uint64
+    key = np.zeros(len(address_df), dtype=np.uint64)
+    for col in address_df.columns:
+        codes, uniques = pd.factorize(address_df[col])
+        parts = np.array([str(value) for value in uniques] + [str(np.nan)], dtype=object)
+        key = key * np.uint64(1099511628211) ^ pd.util.hash_array(parts)[codes]
+    return key
+
+def parse_scan_times(series):
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series
 
-    # Select required columns
-    selected_columns = ['Item_ID', 'Bill_To_Account_Number', 'Tracking_Number', 'Service', 
-                       'ScanCode_DateTime_(MM/DD/YYYY_HH:mm:ss)', 'Status', 'Status_Description', 
-                       'Route_Code', 'Ship_To_Name', 'Ship_To_Address', 'Ship_To_Address_2', 
-                       'Ship_To_City', 'Ship_To_State/Province', 'Ship_To_Postal_Code/ZIP', 
-                       'Ship_To_Country', 'Delivery_Driver_Name', 'Delivery_Address',
-                       'Delivery_City', 'Delivery_Province', 'Delivery_Postal_Code/ZIP', 
-                       'Delivery_Country', 'Latitude', 'Longitude', 'Client_Name']
+    # Parse each distinct timestamp string once with the fixed export format;
+    # other layouts are inferred and what cannot be read at all becomes NaT
+    codes, uniques = pd.factorize(series)
+    parsed = pd.Series(pd.to_datetime(uniques, format=SCAN_TIME_FORMAT, errors='coerce'))
+    failed = parsed.isna().to_numpy()
+    if failed.any():
+        parsed[failed] = pd.to_datetime(pd.Series(uniques[failed]), format='mixed', errors='coerce').to_numpy()
+    parsed = pd.DatetimeIndex(parsed)
+    return pd.Series(parsed.take(codes, allow_fill=True, fill_value=pd.NaT), index=series.index, name=series.name)
 
-    df_selected = df[selected_columns].copy()
+def time_of_day_seconds(scan_dates, dates):
+    # Rows without a timestamp have no Date either and never reach a group
+    seconds = (scan_dates - dates).dt.total_seconds().fillna(0)
+    return seconds.astype(np.int32)
+
+def display_times(seconds):
+    return pd.to_datetime(seconds, unit='s').dt.time
+
+def _display_types(result_df):
+    # Dates and times stay numeric through the pipeline and are only turned
+    # into date/time objects for the report itself
+    result_df['Date'] = result_df['Date'].dt.date
+    result_df['Start_Time'] = display_times(result_df['Start_Time'])
+    result_df['End_Time'] = display_times(result_df['End_Time'])
+    return result_df
+
+def clean_scans(df):
+    # Everything prepare_scans does that does not depend on the dispatch rules
+    # Clean column names
+    normalize_columns(df)
+    check_columns(df.columns)
+
+    df_selected = df[SELECTED_COLUMNS].copy()
+    rows = len(df_selected)
 
     # Clean text in relevant columns
-    columns_to_clean = ['Ship_To_Name', 'Ship_To_Address', 'Ship_To_Address_2', 'Ship_To_City',
-                       'Ship_To_State/Province', 'Ship_To_Postal_Code/ZIP', 'Ship_To_Country', 
-                       'Delivery_City']
-    
-    for col in columns_to_clean:
-        df_selected[col] = df_selected[col].apply(clean_text)
-
-    # Create full address
-    df_selected['Ship_To_Full_Address'] = df_selected['Ship_To_Name'].astype(str) + ', ' + \
-                                        df_selected['Ship_To_Address'].astype(str) + ', ' + \
-                                        df_selected['Ship_To_Address_2'].astype(str) + ', ' + \
-                                        df_selected['Ship_To_City'].astype(str) + ', ' + \
-                                        df_selected['Ship_To_State/Province'].astype(str) + ', ' + \
-                                        df_selected['Ship_To_Postal_Code/ZIP'].astype(str) + ', ' + \
-                                        df_selected['Ship_To_Country'].astype(str)
+    with stage('clean', rows):
+        for col in COLUMNS_TO_CLEAN:
+            df_selected[col] = clean_column(df_selected[col])
+
+    # Key the full address by a hash of its parts instead of joining the strings
+    with stage('address_key', rows):
+        df_selected['Ship_To_Address_Key'] = address_key(df_selected[ADDRESS_COLUMNS])
 
     # Process dates and times
-    df_selected = df_selected.rename(columns={'ScanCode_DateTime_(MM/DD/YYYY_HH:mm:ss)': 'Scan_Date'})
-    df_selected['Scan_Date'] = pd.to_datetime(df_selected['Scan_Date'])
-    df_selected['Date'] = df_selected['Scan_Date'].dt.date
-    df_selected['Time'] = df_selected['Scan_Date'].dt.time
+    with stage('timestamps', rows):
+        df_selected = df_selected.rename(columns=RENAMED_COLUMNS)
+        scan_text = df_selected['Scan_Date']
+        df_selected['Scan_Date'] = parse_scan_times(scan_text)
+        # The text of timestamps that could not be read, for the quality report
+        unreadable = scan_text.notna() & df_selected['Scan_Date'].isna()
+        df_selected['Unparsed_Scan_Time'] = scan_text.where(unreadable).astype('category')
+        df_selected['Date'] = df_selected['Scan_Date'].dt.normalize()
+        df_selected['Time'] = time_of_day_seconds(df_selected['Scan_Date'], df_selected['Date'])
+    return df_selected
+
+def classify_scans(df_selected, rules=None):
+    with stage('classify', len(df_selected)):
+        return (rules or get_rules()).categorize_statuses(df_selected['Status']).rename('Updated_Status')
+
+@instrumented('prepare')
+def prepare_scans(df):
+    df_selected = clean_scans(df)
 
     # Categorize status
-    df_selected['Updated_Status'] = df_selected['Status'].apply(categorize_status)
+    df_selected['Updated_Status'] = classify_scans(df_selected)
+    return df_selected
+
+# Prepared scan columns the route partials are built from
+EVENT_COLUMNS = GROUP_KEYS + ['Item_ID', 'Status', 'Scan_Date', 'Time', 'Delivery_City',
+                              'Ship_To_Address_Key', 'Latitude', 'Longitude', 'Client_Name']
+
+# Partial state is kept as small frames that can be concatenated and reduced
+# again, so chunks of one export merge into exactly the in-memory result.
+ITEM_STATUSES = ['OFD Scans', 'Delivered', 'Return']
+
+# The item timeline holds one row per item and day. For each lifecycle event
+# it keeps the time, route and driver of the item's latest such scan.
+TIMELINE_KEYS = ['Item_ID', 'Date']
+TIMELINE_EVENTS = [('OFD', 'OFD Scans'), ('Delivered', 'Delivered'), ('Return', 'Return')]
+TIMELINE_COLUMNS = TIMELINE_KEYS + ['First_OFD_Time', 'OFD_Attempts'] + [
+    f"{prefix}_{field}" for prefix, _ in TIMELINE_EVENTS for field in ('Time', 'Route', 'Driver')
+] + ['Last_Scan_Time', 'Final_Status']
+
+# Delivered scans with a position, for the route geometry
+STOP_COLUMNS = GROUP_KEYS + ['Scan_Date', 'Latitude', 'Longitude']
+
+EARTH_RADIUS_KM = 6371.0088
+
+def _reduce_routes(routes, time_columns=('Start_Time', 'End_Time')):
+    return routes.groupby(GROUP_KEYS, observed=True).agg(
+        Start_Time=(time_columns[0], 'min'),
+        End_Time=(time_columns[1], 'max'),
+        Delivery_City=('Delivery_City', 'first'),
+    ).reset_index()
+
+@instrumented('timeline')
+def item_timeline(df_selected):
+    scans = df_selected.loc[df_selected['Item_ID'].notna() & df_selected['Date'].notna(),
+                            TIMELINE_KEYS + ['Scan_Date', 'Updated_Status', 'Route_Code', 'Delivery_Driver_Name']]
+    status = scans['Updated_Status']
+    located = scans['Route_Code'].notna() & scans['Delivery_Driver_Name'].notna()
 
-    # Create base result DataFrame
-    result_df = df_selected[df_selected['Updated_Status'] == 'OFD Scans'].groupby(
-        ['Date', 'Delivery_Driver_Name', 'Route_Code'])['Item_ID'].nunique().reset_index()
-    result_df = result_df.rename(columns={'Item_ID': 'Number_of_Packages'})
+    # Each scan fills the fields of its own event; scans without a route or
+    # driver only count as attempts and for the final status
+    events = {key: scans[key] for key in TIMELINE_KEYS}
+    events['First_OFD_Time'] = scans['Scan_Date'].where(status == 'OFD Scans')
+    events['OFD_Attempts'] = (status == 'OFD Scans').astype(np.int32)
+    for prefix, name in TIMELINE_EVENTS:
+        hit = (status == name) & located
+        events[f"{prefix}_Time"] = scans['Scan_Date'].where(hit)
+        events[f"{prefix}_Route"] = scans['Route_Code'].where(hit)
+        events[f"{prefix}_Driver"] = scans['Delivery_Driver_Name'].where(hit)
+    events['Last_Scan_Time'] = scans['Scan_Date']
+    events['Final_Status'] = status
+    events = pd.DataFrame(events)
 
-    # Add number of stops
-    stops_df = df_selected.groupby(['Date', 'Delivery_Driver_Name', 'Route_Code'])['Ship_To_Full_Address'].nunique().reset_index(name='Number_of_Stops')
-    result_df = pd.merge(result_df, stops_df, on=['Date', 'Delivery_Driver_Name', 'Route_Code'], how='left')
+    # One stable sort puts every item's scans in time order, file order on
+    # ties, so 'last' (which skips missing values) is the latest scan of each event
+    events = events.sort_values(TIMELINE_KEYS + ['Last_Scan_Time'], kind='stable')
+    aggregations = {column: 'last' for column in TIMELINE_COLUMNS[len(TIMELINE_KEYS):]}
+    aggregations.update(First_OFD_Time='min', OFD_Attempts='sum')
+    return events.groupby(TIMELINE_KEYS, sort=False, observed=True).agg(aggregations).reset_index()
 
-    # Add city information
-    city_df = df_selected.groupby(['Date', 'Delivery_Driver_Name', 'Route_Code'])['Delivery_City'].first().reset_index()
-    result_df = pd.merge(result_df, city_df, on=['Date', 'Delivery_Driver_Name', 'Route_Code'], how='left')
+def _latest(frame, time_column, columns):
+    # The later row wins on equal times; timelines are concatenated in file order
+    frame = frame.loc[frame[time_column].notna(), TIMELINE_KEYS + [time_column] + columns]
+    frame = frame.sort_values(TIMELINE_KEYS + [time_column], kind='stable')
+    return frame.drop_duplicates(TIMELINE_KEYS, keep='last').set_index(TIMELINE_KEYS)
+
+def _reduce_timeline(timeline):
+    # Timelines of one item from different chunks are ordered per event
+    reduced = timeline.groupby(TIMELINE_KEYS, observed=True).agg(
+        First_OFD_Time=('First_OFD_Time', 'min'), OFD_Attempts=('OFD_Attempts', 'sum'))
+    for prefix, _ in TIMELINE_EVENTS:
+        reduced = reduced.join(_latest(timeline, f"{prefix}_Time", [f"{prefix}_Route", f"{prefix}_Driver"]))
+    reduced = reduced.join(_latest(timeline, 'Last_Scan_Time', ['Final_Status']))
+    return reduced.reset_index()[TIMELINE_COLUMNS]
+
+def delivery_stops(df_selected):
+    # Missing, out of range and 0,0 positions are not usable fixes
+    latitude = pd.to_numeric(df_selected['Latitude'], errors='coerce')
+    longitude = pd.to_numeric(df_selected['Longitude'], errors='coerce')
+    usable = ((df_selected['Updated_Status'] == 'Delivered') & df_selected['Scan_Date'].notna()
+              & df_selected[GROUP_KEYS].notna().all(axis=1)
+              & latitude.between(-90, 90) & longitude.between(-180, 180) & ((latitude != 0) | (longitude != 0)))
+    stops = df_selected.loc[usable, GROUP_KEYS + ['Scan_Date']].assign(Latitude=latitude[usable],
+                                                                        Longitude=longitude[usable])
+    # Repeated fixes add no distance
+    return stops.drop_duplicates()
+
+def haversine_km(latitude1, longitude1, latitude2, longitude2):
+    latitude1, longitude1, latitude2, longitude2 = map(np.radians, (latitude1, longitude1, latitude2, longitude2))
+    a = (np.sin((latitude2 - latitude1) / 2) ** 2
+         + np.cos(latitude1) * np.cos(latitude2) * np.sin((longitude2 - longitude1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+@instrumented('geometry')
+def route_distances(stops):
+    # Each route's deliveries in time order (position on equal times), summing
+    # the legs between consecutive ones over flat arrays
+    stops = _decategorize(stops)
+    route = stops.groupby(GROUP_KEYS, sort=False).ngroup().to_numpy()
+    latitude, longitude = stops['Latitude'].to_numpy(), stops['Longitude'].to_numpy()
+    order = np.lexsort((longitude, latitude, stops['Scan_Date'].to_numpy(), route))
+    route, latitude, longitude = route[order], latitude[order], longitude[order]
+
+    first = np.ones(len(route), dtype=bool)
+    first[1:] = route[1:] != route[:-1]
+    legs = np.zeros(len(route))
+    legs[1:] = haversine_km(latitude[:-1], longitude[:-1], latitude[1:], longitude[1:])
+    legs[first] = 0
+    distances = stops.iloc[order[first]][GROUP_KEYS].reset_index(drop=True)
+    distances['Distance_km'] = np.add.reduceat(legs, np.flatnonzero(first)) if len(route) else 0.0
+    return distances
+
+# Partial frames in a fixed order, for stores that keep them as a list
+PARTIAL_NAMES = ['routes', 'addresses', 'items', 'timeline', 'stops']
+
+def route_partials(df_selected):
+    items = df_selected.loc[df_selected['Updated_Status'].isin(ITEM_STATUSES),
+                            GROUP_KEYS + ['Updated_Status', 'Item_ID']]
+    return {
+        'routes': _reduce_routes(df_selected, time_columns=('Time', 'Time')),
+        'addresses': df_selected[GROUP_KEYS + ['Ship_To_Address_Key']].dropna().drop_duplicates(),
+        'items': items.dropna(subset=GROUP_KEYS).drop_duplicates(),
+        'timeline': item_timeline(df_selected),
+        'stops': delivery_stops(df_selected),
+    }
+
+@instrumented('merge')
+def merge_partials(partials):
+    # Partials must be passed in file order so the first city stays the first one seen
+    merged = {name: pd.concat([p[name] for p in partials], ignore_index=True) for name in partials[0]}
+    return {
+        'routes': _reduce_routes(merged['routes']),
+        'addresses': merged['addresses'].drop_duplicates(),
+        'items': merged['items'].drop_duplicates(),
+        'timeline': _reduce_timeline(merged['timeline']),
+        'stops': merged['stops'].drop_duplicates(),
+    }
+
+def partials_nbytes(partials):
+    return sum(int(frame.memory_usage(deep=True).sum()) for frame in partials.values())
+
+def _count_by_route(result_df, frame, column='Item_ID'):
+    counts = frame.groupby(GROUP_KEYS, observed=True)[column].count()
+    index = pd.MultiIndex.from_frame(result_df[GROUP_KEYS])
+    return counts.reindex(index, fill_value=0).to_numpy()
+
+def _timeline_rows(timeline, prefix, *others):
+    # The items with a located event, keyed by that event's route, with the
+    # other events' routes and drivers as plain values for comparison
+    columns = [f"{name}_{field}" for name in others for field in ('Route', 'Driver')]
+    rows = timeline.loc[timeline[f"{prefix}_Route"].notna(),
+                        ['Item_ID', 'Date', f"{prefix}_Driver", f"{prefix}_Route"] + columns]
+    rows = _decategorize(rows)
+    return rows.rename(columns={f"{prefix}_Driver": 'Delivery_Driver_Name', f"{prefix}_Route": 'Route_Code'})
+
+def confirmed_returns(items):
+    # Distinct items returned on a route that were not also delivered on that route
+    returned = items.loc[items['Updated_Status'] == 'Return', GROUP_KEYS + ['Item_ID']]
+    delivered = items.loc[items['Updated_Status'] == 'Delivered', GROUP_KEYS + ['Item_ID']]
+    returned = returned.merge(delivered, on=GROUP_KEYS + ['Item_ID'], how='left', indicator=True)
+    return returned[returned['_merge'] == 'left_only']
+
+@instrumented('aggregate')
+def aggregate_routes(partials):
+    items = partials['items']
+    ofd_items = items.loc[items['Updated_Status'] == 'OFD Scans', GROUP_KEYS + ['Item_ID']]
+    delivered_items = items.loc[items['Updated_Status'] == 'Delivered', GROUP_KEYS + ['Item_ID']]
+
+    # Only routes with OFD scans make it into the report, even if none has an Item_ID
+    result_df = ofd_items.groupby(GROUP_KEYS, observed=True)['Item_ID'].count().rename('Number_of_Packages').reset_index()
+    result_df['Number_of_Stops'] = _count_by_route(result_df, partials['addresses'], 'Ship_To_Address_Key')
+    result_df = result_df.join(partials['routes'].set_index(GROUP_KEYS), on=GROUP_KEYS)
+    result_df['Delivered_No'] = _count_by_route(result_df, delivered_items)
+    result_df['Confirmed_Return'] = _count_by_route(result_df, confirmed_returns(items))
+    return result_df
+
+@instrumented('mismatch')
+def count_mismatches(partials):
+    # Each item is resolved once per day from its timeline: the route of its
+    # last OFD scan against the route of its last delivery scan
+    resolved = _timeline_rows(partials['timeline'], 'OFD', 'Delivered')
+
+    # Delivered by the driver who took it out, but scanned under another route
+    mismatched = resolved[resolved['Delivered_Route'].notna()
+                          & (resolved['Route_Code'] != resolved['Delivered_Route'])
+                          & (resolved['Delivery_Driver_Name'] == resolved['Delivered_Driver'])]
+
+    # Counted on the OFD route's row, with the routes it was delivered under
+    counts = mismatched.groupby(GROUP_KEYS).size().rename('Mismatch_Count')
+    routes = (mismatched[GROUP_KEYS + ['Delivered_Route']].drop_duplicates()
+              .sort_values('Delivered_Route').groupby(GROUP_KEYS)['Delivered_Route'].agg(', '.join)
+              .rename('Mismatch_Route'))
+    return pd.concat([routes, counts], axis=1).reset_index()
+
+def lifecycle_kpis(partials):
+    # Per OFD route: items taken out, OFD attempts per item, how many were
+    # delivered or returned, and minutes from first OFD scan to delivery
+    timeline = _timeline_rows(partials['timeline'], 'OFD')
+    timeline = timeline.join(partials['timeline'][['OFD_Attempts', 'First_OFD_Time', 'Delivered_Time', 'Return_Time']])
+    latency = (timeline['Delivered_Time'] - timeline['First_OFD_Time']).dt.total_seconds() / 60
+    timeline = timeline.assign(Latency=latency.where(latency >= 0))
+    kpis = timeline.groupby(GROUP_KEYS).agg(
+        Items=('Item_ID', 'size'),
+        Attempts_per_Item=('OFD_Attempts', 'mean'),
+        Delivered=('Delivered_Time', 'count'),
+        Returned=('Return_Time', 'count'),
+        Median_Delivery_Minutes=('Latency', 'median'),
+        Max_Delivery_Minutes=('Latency', 'max'),
+    ).reset_index()
+    kpis['Delivery_Rate'] = kpis['Delivered'] / kpis['Items']
+    kpis['Date'] = kpis['Date'].dt.date
+    return kpis
+
+def _decategorize(df):
+    categorical = df.select_dtypes('category').columns
+    return df.astype({col: object for col in categorical})
+
+def route_metrics(partials, rules=None):
+    # Everything the report needs per route except the rates
+    rules = rules or get_rules()
+    result_df = aggregate_routes(partials)
+
+    # Report categorical keys as plain values
+    result_df = _decategorize(result_df)
 
     # Add service categorization
-    result_df['Service'] = result_df['Route_Code'].apply(categorize_service)
-
-    # Add timing information
-    result_df['Start_Time'] = result_df.apply(lambda row: df_selected[
-        (df_selected['Date'] == row['Date']) &
-        (df_selected['Delivery_Driver_Name'] == row['Delivery_Driver_Name']) &
-        (df_selected['Route_Code'] == row['Route_Code'])]['Time'].min(), axis=1)
-
-    result_df['End_Time'] = result_df.apply(lambda row: df_selected[
-        (df_selected['Date'] == row['Date']) &
-        (df_selected['Delivery_Driver_Name'] == row['Delivery_Driver_Name']) &
-        (df_selected['Route_Code'] == row['Route_Code'])]['Time'].max(), axis=1)
-
-    # Add delivery and return metrics
-    result_df['Delivered_No'] = result_df.apply(lambda row: df_selected[
-        (df_selected['Date'] == row['Date']) &
-        (df_selected['Delivery_Driver_Name'] == row['Delivery_Driver_Name']) &
-        (df_selected['Route_Code'] == row['Route_Code']) &
-        (df_selected['Updated_Status'] == 'Delivered')]['Item_ID'].nunique(), axis=1)
-
-    # Process route mismatches
-    ofd_df = df_selected[df_selected['Updated_Status'] == 'OFD Scans'][['Item_ID', 'Date', 'Route_Code', 'Delivery_Driver_Name']]
-    ofd_df = ofd_df.rename(columns={'Route_Code': 'OFD_Route', 'Delivery_Driver_Name': 'OFD_Driver'})
-
-    delivered_df = df_selected[df_selected['Updated_Status'] == 'Delivered'][['Item_ID', 'Date', 'Route_Code', 'Delivery_Driver_Name']]
-    delivered_df = delivered_df.rename(columns={'Route_Code': 'Delivery_Route', 'Delivery_Driver_Name': 'Delivery_Driver'})
-
-    merged_df = pd.merge(ofd_df, delivered_df, on=['Item_ID', 'Date'], how='inner')
-    wrong_ofd_df = merged_df[merged_df['OFD_Route'] != merged_df['Delivery_Route']]
-    correct_ofd_df = wrong_ofd_df[wrong_ofd_df['OFD_Driver'] == wrong_ofd_df['Delivery_Driver']]
-
-    mismatch_count_df = correct_ofd_df.groupby(['Date','OFD_Driver','OFD_Route','Delivery_Route'])['Item_ID'].count().reset_index()
-    mismatch_count_df = mismatch_count_df.rename(columns={
-        'Item_ID': 'Mismatch_Count',
-        'OFD_Driver': 'Delivery_Driver_Name',
-        'OFD_Route': 'Route_Code'
-    })
-
-    # Merge mismatch information
-    result_df = pd.merge(
-        result_df,
-        mismatch_count_df[['Date', 'Delivery_Driver_Name', 'Delivery_Route', 'Mismatch_Count']],
-        on=['Date', 'Delivery_Driver_Name'],
-        how='left'
-    )
-    
+    result_df['Service'] = rules.categorize_services(result_df['Route_Code'])
+
+    # Merge mismatch information; one row per route, so no route is repeated
+    mismatch_count_df = count_mismatches(partials)
+    result_df = pd.merge(result_df, mismatch_count_df, on=GROUP_KEYS, how='left', validate='one_to_one')
     result_df['Mismatch_Count'] = result_df['Mismatch_Count'].fillna(0).astype(int)
-    result_df = result_df.rename(columns={'Delivery_Route': 'Mismatch_Route'})
-
-    # Calculate confirmed returns
-    result_df['Confirmed_Return'] = result_df.apply(lambda row: df_selected[
-        (df_selected['Date'] == row['Date']) &
-        (df_selected['Delivery_Driver_Name'] == row['Delivery_Driver_Name']) &
-        (df_selected['Route_Code'] == row['Route_Code']) &
-        (df_selected['Updated_Status'] == 'Return') &
-        (~df_selected['Item_ID'].isin(df_selected[
-            (df_selected['Date'] == row['Date']) &
-            (df_selected['Delivery_Driver_Name'] == row['Delivery_Driver_Name']) &
-            (df_selected['Route_Code'] == row['Route_Code']) &
-            (df_selected['Updated_Status'] == 'Delivered')
-        ]['Item_ID']))
-    ]['Item_ID'].nunique(), axis=1)
-
-    # Calculate rates and amounts
-    result_df['Rates'] = result_df.apply(calculate_rate, axis=1)
-    result_df['Amount_to_be_paid'] = (result_df['Delivered_No'] + result_df['Mismatch_Count']) * result_df['Rates']
+    result_df = _decategorize(result_df)
+
+    # Distance between consecutive deliveries, and the rates derived from it
+    # and from the route's first to last scan; blank where undefined
+    result_df = result_df.join(route_distances(partials['stops']).set_index(GROUP_KEYS), on=GROUP_KEYS)
+    result_df['Distance_km'] = result_df['Distance_km'].fillna(0.0)
+    result_df['Packages_per_km'] = result_df['Number_of_Packages'] / result_df['Distance_km'].where(result_df['Distance_km'] > 0)
+    hours = (result_df['End_Time'] - result_df['Start_Time']) / 3600
+    result_df['Deliveries_per_hour'] = result_df['Delivered_No'] / hours.where(hours > 0)
+    return result_df
+
+def apply_rates(result_df, rules=None):
+    # Returns a new frame, so route metrics can be priced again under other rates
+    rules = rules or get_rules()
+    with stage('rates', len(result_df)):
+        rates = rules.calculate_rates(result_df['Service'], result_df['Delivery_City'])
+        return result_df.assign(Rates=rates.to_numpy(),
+                                Amount_to_be_paid=(result_df['Delivered_No'] + result_df['Mismatch_Count']) * rates.to_numpy())
+
+def finish_report(result_df):
+    return split_services(_display_types(result_df[RESULT_COLUMNS].copy()))
 
+@instrumented('report')
+def build_report(partials):
+    rules = get_rules()
+    return finish_report(apply_rates(route_metrics(partials, rules), rules))
+
+def split_services(result_df):
     # Split into service-specific DataFrames
     return (
         result_df[result_df['Service'] == 'Next Day'],
@@ -200,11 +446,14 @@ def process_dispatch_data(df):
         result_df[result_df['Service'] == 'Montreal']
     )
 
+@instrumented('process')
+def process_dispatch_data(df):
+    df_selected = prepare_scans(df)
+    return build_report(route_partials(df_selected))
+
 def create_excel_report(next_day_df, same_day_df, montreal_df):
+    # Kept for callers that want the workbook in memory; see exports.export_file
     buffer = io.BytesIO()
-    with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
-        next_day_df.to_excel(writer, sheet_name='Next_Day', index=False)
-        same_day_df.to_excel(writer, sheet_name='Same_Day', index=False)
-        montreal_df.to_excel(writer, sheet_name='Montreal', index=False)
+    write_xlsx((next_day_df, same_day_df, montreal_df), buffer)
     buffer.seek(0)
     return buffer
@@ -1,269 +1,166 @@
 #!/usr/bin/env python
-# coding: utf-8
-
-# In[1]:
-
-
-import pandas as pd
-import re
-import warnings
-
-warnings.filterwarnings('ignore')
-
-
-# In[2]:
-
-
-df = pd.read_csv('History_20250313135145.csv')
-
-
-# In[3]:
-
-
-# in column names remove spaces and replace space between words with underscore
-
-df.columns = df.columns.str.replace(' ', '_')
-
-
-# In[4]:
-
-
-# select only item id, Bill_To_Account_Number    ,Tracking_Number,3   Service                   ,,Scan_Date                 ,Status,Status_Description,Route_Code,8   Delivery_Driver_Name      ,Delivery_Address          ,Delivery_City             ,Delivery_Province         ,Delivery_Postal_Code_ZIP  ,Delivery_Country          ,Latitude  ,Longitude                 ,Client_Name
-
-selected_columns = ['Item_ID', 'Bill_To_Account_Number', 'Tracking_Number', 'Service', 'ScanCode_DateTime_(MM/DD/YYYY_HH:mm:ss)',
-                    'Status', 'Status_Description', 'Route_Code','Delivery_Driver_Name', 'Delivery_Address',
-                    'Delivery_City', 'Delivery_Province', 'Delivery_Postal_Code/ZIP', 'Delivery_Country',
-                    'Latitude', 'Longitude', 'Client_Name']
-df_selected = df[selected_columns]
-
-
-# In[5]:
-
-
-def clean_city(city):
-    city = re.sub(r'[^a-zA-Z0-9\s]', '', str(city)) #remove special characters
-    city = city.title() #convert to sentence case
-    return city
-
-df_selected['Delivery_City'] = df_selected['Delivery_City'].apply(clean_city)
-
-
-# In[6]:
-
-
-#  rename ScanCode_DateTime_(MM/DD/YYYY_HH:mm:ss)  to Scan_Date
-df_selected = df_selected.rename(columns={'ScanCode_DateTime_(MM/DD/YYYY_HH:mm:ss)': 'Scan_Date'})
-
-
-# In[7]:
-
-
-# Convert 'Scan_Date' column to datetime
-df_selected['Scan_Date'] = pd.to_datetime(df_selected['Scan_Date'])
-
-
-# In[8]:
-
-
-# extract date part of ScanCode_DateTime_(MM/DD/YYYY_HH:mm:ss) and time part and show it
-
-# Extract date and time parts
-df_selected['Date'] = df_selected['Scan_Date'].dt.date
-df_selected['Time'] = df_selected['Scan_Date'].dt.time
-
-
-# In[9]:
-
-
-delivered_statuses = ["DEL_VERBAL", "DEL_ASR", "DEL_SIG", "DEL_OSNR"]
-ofd_scan_statuses = ["ITR_OFD", "FEDEX_ACCEPTED", "PIC_CANPAR", "PURO_ACCEPTED"]
-return_statuses = ["EXC_BADADDRESS", "EXC_CONS_NA", "EXC_DMG", "EXC_MECHDELAY", "EXC_MISSING",
-                   "EXC_MISSORT", "EXC_NOACCESS", "EXC_NODELATTEMPT", "EXC_REC_NA", "EXC_RECCLOSED",
-                   "EXC_RECUNNDKL", "EXC_REFUSED", "EXC_UNSAFE", "EXC_WEATHER", "RET_PUR",
-                   "RET_TOR", "RET_WAR", "REC_TOR"]
-scansort_statuses = ["SCANSORT"]
-manifested_statuses=['1']
-AJTM_statuses = ["AJTM"]
-lost_in_transit_statuses = ["LOST_IN_TRANSIT"]
-pickup_statuses = ["PU01"]
-
-def categorize_status(status):
-  if status in delivered_statuses:
-    return "Delivered"
-  elif status in ofd_scan_statuses:
-    return "OFD Scans"
-  elif status in return_statuses:
-    return "Return"
-  elif status in scansort_statuses:
-    return "Scansort"
-  elif status in lost_in_transit_statuses:
-    return "Lost in Transit"
-  elif status in pickup_statuses:
-    return "Pickup"
-  elif status in AJTM_statuses:
-    return "AJTM"
-  elif status in manifested_statuses:
-    return "Manifested"
-  else:
-    return "Other"  # or handle unknown statuses as needed
-
-df_selected['Updated_Status'] = df_selected['Status'].apply(categorize_status)
-
-
-# In[10]:
-
-
-# select the updated status with other
-
-df_selected[df_selected['Updated_Status'] == 'Other']
-
-
-# In[11]:
-
-
-# select driver name route number and number of packages (number of packages condition is updated_status=ofd scans) from zara_df datewise and also seggregate by service wise
-
-# Group by date, service, driver, and route, then count packages with 'OFD Scans' status
-result_df = df_selected[df_selected['Updated_Status'] == 'OFD Scans'].groupby(['Date', 'Delivery_Driver_Name', 'Route_Code'])['Item_ID'].nunique().reset_index()
-
-# Rename the 'Item_ID' column to 'Number_of_Packages'
-result_df = result_df.rename(columns={'Item_ID': 'Number_of_Packages'})
-
-# Display the result
-result_df.head(2)
-
-
-# In[12]:
-
-
-# First, group df_selected by 'Date', 'Delivery_Driver_Name', 'Route_Code' to get the corresponding 'Delivery_City'
-
-city_df = df_selected.groupby(['Date', 'Delivery_Driver_Name', 'Route_Code'])['Delivery_City'].first().reset_index()
-
-# Now merge this city_df with the result_df
-result_df = pd.merge(result_df, city_df, on=['Date', 'Delivery_Driver_Name', 'Route_Code'], how='left')
-
-
-# In[13]:
-
-
-route = result_df['Route_Code'].unique()
-print(route)
-
-
-# In[14]:
-
-
-#  Add a new column that says service, condition is route code starting with 'Z-R' service is next day and route code starting with 'Z-SD' service is Same day, route code starting with Z-M service montreal
-
-def categorize_service(route_code):
-    if route_code.startswith('YYZ-SD'):  # Check for "Same Day" first
-        return 'Same Day'
-    elif route_code.startswith('YYZ-'):  # Then check for "Next Day"
-        return 'Next Day'
-    elif route_code.startswith('YUL-'):
-        return 'Montreal'
-    else:
-        return 'Other'
-
-result_df['Service'] = result_df['Route_Code'].apply(categorize_service)
-
-
-# In[15]:
-
-
-#  add two column named as Start time and End time  in result_df for Start time take the initial scan date time in  from Time in df_selected dataframe for each driver for each date and for every route code and for end time it should be the last scan time done on that day
-# Create 'Start_Time' and 'End_Time' columns
-result_df['Start_Time'] = result_df.apply(lambda row: df_selected[(df_selected['Date'] == row['Date']) &
-                                                                (df_selected['Delivery_Driver_Name'] == row['Delivery_Driver_Name']) &
-                                                                (df_selected['Route_Code'] == row['Route_Code'])]['Time'].min(), axis=1)
-
-result_df['End_Time'] = result_df.apply(lambda row: df_selected[(df_selected['Date'] == row['Date']) &
-                                                              (df_selected['Delivery_Driver_Name'] == row['Delivery_Driver_Name']) &
-                                                              (df_selected['Route_Code'] == row['Route_Code'])]['Time'].max(), axis=1)
-result_df.head(2)
-
-
-# In[16]:
-
-
-# add a column named delivered no with condition of count of unique item id with updated status delevered into this df result_df
-
-# Calculate 'Delivered_No' based on the condition
-result_df['Delivered_No'] = result_df.apply(lambda row: df_selected[(df_selected['Date'] == row['Date']) &
-                                                                    (df_selected['Delivery_Driver_Name'] == row['Delivery_Driver_Name']) &
-                                                                    (df_selected['Route_Code'] == row['Route_Code']) &
-                                                                    (df_selected['Updated_Status'] == 'Delivered')]['Item_ID'].nunique(), axis=1)
-
-
-# In[17]:
-
-
-# Calculate 'Confirmed_Return'
-result_df['Confirmed_Return'] = result_df.apply(lambda row: df_selected[
-    (df_selected['Date'] == row['Date']) &
-    (df_selected['Delivery_Driver_Name'] == row['Delivery_Driver_Name']) &
-    (df_selected['Route_Code'] == row['Route_Code']) &
-    (df_selected['Updated_Status'] == 'Return') &
-    (~df_selected['Item_ID'].isin(df_selected[
-        (df_selected['Date'] == row['Date']) &
-        (df_selected['Delivery_Driver_Name'] == row['Delivery_Driver_Name']) &
-        (df_selected['Route_Code'] == row['Route_Code']) &
-        (df_selected['Updated_Status'] == 'Delivered')
-    ]['Item_ID']))
-]['Item_ID'].nunique(), axis=1)
-
-
-# In[18]:
-
-
-#add a column in result_df named as Rates which hold the values like this Based on service like if service is next day rate is 2.20, id the service is same day rate is 3.5 and if the service is montral then the rate is 3 and if the delivery city is in oakville, burlington then the rate is 2.45 and keep all the decimal
-
-def calculate_rate(row):
-    service = row['Service']
-    city = row['Delivery_City']
-    if service == 'Next Day':
-        if city in ['Oakville', 'Burlington']:
-            return 2.45
+import argparse
+import glob
+import os
+import sys
+from datetime import datetime
+
+from daily_cube import DailyCube
+from data_processor import process_dispatch_data, REPORT_VERSION
+from dispatch_rules import get_rules
+from exports import export_report, write_sheets
+from governor import MemoryGovernor
+from instrumentation import stage, use_hooks, StageRecorder, JsonLogHook, format_records
+from parallel import process_dispatch_files, DEFAULT_WORKERS
+from pipeline import Pipeline
+from result_cache import ResultCache, content_hash, cache_key
+from scan_store import ScanStore
+from schema import read_history
+from sql_engine import process_dispatch_sql, SQL_BACKENDS
+from streaming import process_dispatch_file, DEFAULT_MEMORY_LIMIT
+
+ENGINES = ['auto', 'memory', 'streaming', 'sql', 'parallel']
+FORMATS = ['xlsx', 'csv', 'parquet']
+
+def expand_inputs(patterns):
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            raise FileNotFoundError(f"No files match {pattern}")
+        paths.extend(match for match in matches if match not in paths)
+    return paths
+
+def resolve_engine(engine, paths):
+    if engine == 'auto':
+        return 'parallel' if len(paths) > 1 else 'memory'
+    if engine in ('memory', 'streaming', 'sql') and len(paths) > 1:
+        raise ValueError(f"The {engine} engine takes a single input file; use --engine parallel")
+    return engine
+
+def generate_report(paths, engine, memory_limit, workers, store_dir=None, sql_backend='auto', cache=None,
+                    file_hash=None):
+    if store_dir:
+        return ScanStore(store_dir).ingest_and_report(read_history(path) for path in paths)
+    if engine == 'streaming':
+        return process_dispatch_file(paths[0], memory_limit=memory_limit)
+    if engine == 'sql':
+        return process_dispatch_sql(paths[0], backend=sql_backend, memory_limit=memory_limit)
+    if engine == 'parallel':
+        return process_dispatch_files(paths, workers=workers)
+    if cache is not None:
+        # Reruns after a rules edit reuse the stages the edit does not affect
+        return Pipeline(cache).run(file_hash, lambda: read_history(paths[0]))
+    return process_dispatch_data(read_history(paths[0]))
+
+def write_report(frames, output_dir, fmt, name):
+    if fmt == 'xlsx':
+        os.makedirs(output_dir, exist_ok=True)
+        return [export_report(frames, fmt, os.path.join(output_dir, f"{name}.xlsx"))]
+    return write_sheets(frames, output_dir, fmt, name)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Build the Ecom dispatch report from History CSV exports.")
+    parser.add_argument('inputs', nargs='+', help="History CSV files, plain or .gz/.zst/.zip/.bz2/.xz compressed (.zst needs zstandard), "
+                                                     "or glob patterns, e.g. 'exports/History_*.csv.gz'")
+    parser.add_argument('-o', '--output-dir', default='.', help="Directory the report is written to")
+    parser.add_argument('-f', '--format', choices=FORMATS, default='xlsx', help="xlsx workbook, or one csv or parquet file per service sheet")
+    parser.add_argument('--name', help="Output file name without extension (default: dispatch_report_<timestamp>)")
+    parser.add_argument('--engine', choices=ENGINES, default='auto',
+                        help="auto uses parallel for several inputs and memory for one, "
+                             "streaming it instead when it would not fit in memory")
+    parser.add_argument('--memory-limit-mb', type=int, default=DEFAULT_MEMORY_LIMIT // (1024 * 1024),
+                        help="Memory for the chunks of the streaming and sql engines; the merged "
+                             "per-item state can exceed it")
+    parser.add_argument('--sql-backend', choices=SQL_BACKENDS, default='auto',
+                        help="Database of the sql engine; auto uses duckdb when installed, else sqlite")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help="Worker processes of the parallel engine")
+    parser.add_argument('--cache-dir', help="Reuse reports of identical inputs from this directory")
+    parser.add_argument('--store-dir', help="Ingest into the incremental store in this directory and report from it; "
+                                            "the report covers every date of the inputs, completed with the scans "
+                                            "earlier exports stored for those dates. Not combined with --engine or --cache-dir")
+    parser.add_argument('--cube-dir', help="Also add the report's rows to the payroll cube in this directory; "
+                                           "the report is then built through the incremental store (--store-dir, "
+                                           "by default scans/ in this directory) and covers the stored dates as above")
+    parser.add_argument('--lifecycle', action='store_true',
+                        help="Also write per-route OFD attempts, delivery rate and OFD-to-delivery minutes to "
+                             "<name>_lifecycle.csv; needs the memory engine")
+    parser.add_argument('--profile', action='store_true', help="Print stage timings, rows and memory to stderr")
+    parser.add_argument('--stage-log', help="Append one JSON line per pipeline stage to this file")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    recorder = StageRecorder()
+    hooks = [recorder] + ([JsonLogHook(args.stage_log)] if args.stage_log else [])
+    with use_hooks(*hooks):
+        status, written = run(args)
+    for path in written:
+        print(path)
+    if args.profile:
+        print(format_records(recorder.records), file=sys.stderr)
+    return status
+
+def run(args):
+    try:
+        paths = expand_inputs(args.inputs)
+        engine = resolve_engine(args.engine, paths)
+
+        options = {'sql_backend': args.sql_backend}
+        # The cube replaces whole dates, so its rows come from the store, which
+        # completes each date of the inputs with every earlier export of it
+        store_dir = args.store_dir or (DailyCube.store_dir(args.cube_dir) if args.cube_dir else None)
+        if store_dir and (args.engine != 'auto' or args.cache_dir):
+            raise ValueError("--engine and --cache-dir do not apply when reporting through the incremental store "
+                             "(--store-dir or --cube-dir)")
+
+        def compute():
+            plan = engine, args.memory_limit_mb * 1024 * 1024, args.workers
+            if args.engine != 'auto' or store_dir:
+                return generate_report(paths, *plan, store_dir=store_dir, **options)
+            # auto streams a file, or uses fewer workers, when the report would not fit in memory
+            with MemoryGovernor().admit(paths, *plan) as admitted:
+                return generate_report(paths, *admitted, **options)
+
+        if args.lifecycle and (engine != 'memory' or store_dir):
+            raise ValueError("--lifecycle needs a single input on the memory engine, without the incremental store")
+
+        report_key = None
+        if args.cache_dir:
+            with stage('hash'):
+                hashes = []
+                for path in paths:
+                    with open(path, 'rb') as f:
+                        hashes.append(content_hash(f))
+            # Same keys as the app, so both can share one cache directory
+            file_hash = hashes[0] if len(hashes) == 1 else cache_key(*hashes)
+            cache = ResultCache(disk_dir=args.cache_dir)
+            options.update(cache=cache, file_hash=file_hash)
+            report_key = cache_key(file_hash, 'report', REPORT_VERSION, get_rules().fingerprint())
+
+        kpis = None
+        if args.lifecycle:
+            # The KPIs come from the report's own partials in the in-memory stage chain
+            pipeline = Pipeline(options.get('cache') or ResultCache())
+            frames, kpis = pipeline.run(options.get('file_hash', paths[0]), lambda: read_history(paths[0]),
+                                        ['report', 'lifecycle'])
+        elif report_key:
+            frames = cache.get_or_compute(report_key, compute)
         else:
-            return 2.20
-    elif service == 'Same Day':
-        return 3.5
-    elif service == 'Montreal':
-        return 3
-    else:
-        return 0  # Or handle other cases appropriately
-
-result_df['Rates'] = result_df.apply(calculate_rate, axis=1)
-
-
-# In[19]:
-
-
-# Calculate 'Amount_to_be_paid'
-result_df['Amount_to_be_paid'] = result_df['Delivered_No'] * result_df['Rates']
-
-
-# In[20]:
-
-
-# Create separate DataFrames for different services
-next_day_df = result_df[result_df['Service'] == 'Next Day']
-same_day_df = result_df[result_df['Service'] == 'Same Day']
-montreal_df = result_df[result_df['Service'] == 'Montreal']
-
-
-# In[21]:
-
-
-same_day_df.head()
-
-
-# In[22]:
-
-
-with pd.ExcelWriter('output.xlsx') as writer:
-    next_day_df.to_excel(writer, sheet_name='Next_Day', index=False)
-    same_day_df.to_excel(writer, sheet_name='Same_Day', index=False)
-    montreal_df.to_excel(writer, sheet_name='Montreal', index=False)
-
+            frames = compute()
+
+        if args.cube_dir:
+            DailyCube(args.cube_dir).add_report(frames)
+        name = args.name or f"dispatch_report_{datetime.now():%Y%m%d_%H%M%S}"
+        with stage('export'):
+            written = write_report(frames, args.output_dir, args.format, name)
+            if kpis is not None:
+                written.append(os.path.join(args.output_dir, f"{name}_lifecycle.csv"))
+                kpis.to_csv(written[-1], index=False)
+    except (OSError, ValueError, KeyError, ImportError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1, []
+    return 0, written
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# Status codes, route prefixes and the rate card change monthly, so they live
+# in a JSON file instead of the code. DISPATCH_RULES_PATH points at another copy.
+DEFAULT_RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dispatch_rules.json')
+
+# Config sections each derived value depends on
+STATUS_SECTIONS = ('statuses', 'default_status')
+SERVICE_SECTIONS = ('services', 'default_service')
+RATE_SECTIONS = ('rates', 'rate_overrides', 'default_rate')
+
+class DispatchRules:
+    def __init__(self, config):
+        self.config = config
+
+        # The first category listing a code wins, like the old if/elif chain
+        self.status_map = {}
+        for category, codes in config['statuses'].items():
+            for code in codes:
+                self.status_map.setdefault(code, category)
+        self.default_status = config.get('default_status', 'Other')
+        self.status_labels = list(dict.fromkeys(list(config['statuses']) + [self.default_status]))
+
+        self.service_prefixes = [(rule['prefix'], rule['service']) for rule in config['services']]
+        self.default_service = config.get('default_service', 'Other')
+        self.service_labels = list(dict.fromkeys([service for _, service in self.service_prefixes] + [self.default_service]))
+
+        self.rates = config['rates']
+        # Per-city rates; when several overrides match a row the first listed wins,
+        # in rate_of, calculate_rates and the SQL engine alike
+        self.rate_overrides = config.get('rate_overrides', [])
+        self.default_rate = float(config.get('default_rate', 0.0))
+
+    def fingerprint(self, *sections):
+        # Stable digest of the whole config or of the named sections only
+        config = {section: self.config.get(section) for section in sections} if sections else self.config
+        return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+    def status_of(self, status):
+        return self.status_map.get(status, self.default_status)
+
+    def service_of(self, route_code):
+        if isinstance(route_code, str):
+            for prefix, service in self.service_prefixes:
+                if route_code.startswith(prefix):
+                    return service
+        return self.default_service
+
+    def rate_of(self, service, city):
+        for override in self.rate_overrides:
+            if service == override['service'] and city in override['cities']:
+                return override['rate']
+        return self.rates.get(service, self.default_rate)
+
+    def categorize_statuses(self, statuses):
+        return _lookup(statuses, self.status_of, self.status_labels)
+
+    def categorize_services(self, route_codes):
+        return _lookup(route_codes, self.service_of, self.service_labels)
+
+    def calculate_rates(self, services, cities):
+        rates = services.astype(object).map(self.rates).astype(float).fillna(self.default_rate)
+        # Applied last to first, so the first matching override is the one left
+        for override in reversed(self.rate_overrides):
+            mask = (services == override['service']) & cities.isin(override['cities'])
+            rates[mask.to_numpy()] = float(override['rate'])
+        return rates
+
+def _lookup(values, classify, labels):
+    # Classify each distinct value once and broadcast through the category codes
+    if not isinstance(values.dtype, pd.CategoricalDtype):
+        values = values.astype('category')
+    label_codes = {label: code for code, label in enumerate(labels)}
+    lookup = np.array([label_codes[classify(value)] for value in values.cat.categories]
+                      + [label_codes[classify(np.nan)]], dtype=np.int32)
+    codes = lookup[values.cat.codes.to_numpy()]
+    return pd.Series(pd.Categorical.from_codes(codes, categories=labels), index=values.index, name=values.name)
+
+def load_rules(path=None):
+    with open(path or rules_path()) as f:
+        return DispatchRules(json.load(f))
+
+def rules_path():
+    return os.environ.get('DISPATCH_RULES_PATH', DEFAULT_RULES_PATH)
+
+_loaded = {}
+
+def get_rules():
+    # Reload when the file is edited so rate changes apply without a restart
+    path = rules_path()
+    mtime = os.path.getmtime(path)
+    if _loaded.get('key') != (path, mtime):
+        _loaded['rules'] = load_rules(path)
+        _loaded['key'] = (path, mtime)
+    return _loaded['rules']
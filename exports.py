@@ -0,0 +1,169 @@
+import datetime
+import os
+import shutil
+import tempfile
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import xlsxwriter
+
+from instrumentation import stage, count_rows
+from schema import HAS_PYARROW
+
+# Rendered reports are written to disk rather than memory and reused while
+# the report they belong to is unchanged. Oldest files go first once the
+# directory outgrows its budget.
+DEFAULT_EXPORT_DIR = os.environ.get('DISPATCH_EXPORT_DIR') or os.path.join(tempfile.gettempdir(), 'dispatch_exports')
+DEFAULT_EXPORT_BYTES = int(os.environ.get('DISPATCH_EXPORT_DISK_MB', '2048')) * 1024 * 1024
+
+SHEETS = ['Next_Day', 'Same_Day', 'Montreal']
+# Written after the service sheets when the report carries a row-quality frame
+QUALITY_SHEET = 'Data_Quality'
+
+# Format name -> (file extension, mime type). csv and parquet hold one file
+# per service sheet, so a single download packs them into a zip.
+FORMATS = {
+    'xlsx': ('xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    'csv': ('zip', 'application/zip'),
+    'parquet': ('zip', 'application/zip'),
+}
+
+# Same look as pandas' to_excel output
+HEADER_FORMAT = {'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'}
+DATE_FORMAT = 'YYYY-MM-DD'
+DATETIME_FORMAT = 'YYYY-MM-DD HH:MM:SS'
+
+def _write_object(sheet, row, col, value, formats):
+    # Mirrors pandas' ExcelWriter value conversion, times included as text
+    if value is None or (isinstance(value, float) and np.isnan(value)) or value is pd.NaT:
+        return
+    if isinstance(value, (bool, np.bool_)):
+        sheet.write_boolean(row, col, bool(value))
+    elif isinstance(value, (int, float, np.integer, np.floating)):
+        sheet.write_number(row, col, value)
+    elif isinstance(value, datetime.datetime):
+        sheet.write_datetime(row, col, value, formats['datetime'])
+    elif isinstance(value, datetime.date):
+        sheet.write_datetime(row, col, value, formats['date'])
+    else:
+        sheet.write_string(row, col, str(value))
+
+def _column_writer(series, sheet, formats):
+    if pd.api.types.is_bool_dtype(series.dtype):
+        return series.tolist(), lambda row, col, value: sheet.write_boolean(row, col, value)
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        def write_number(row, col, value):
+            if value == value:
+                sheet.write_number(row, col, value)
+        return series.tolist(), write_number
+    if pd.api.types.is_datetime64_any_dtype(series.dtype):
+        values = series.dt.to_pydatetime().tolist()
+    else:
+        values = series.tolist()
+    return values, lambda row, col, value: _write_object(sheet, row, col, value, formats)
+
+def write_xlsx(frames, target, sheets=SHEETS + [QUALITY_SHEET]):
+    # constant_memory flushes every finished row to a temp file, so only one
+    # row of each sheet is held while writing; sheets are written in order
+    with stage('export_xlsx', count_rows(frames)):
+        workbook = xlsxwriter.Workbook(target, {'constant_memory': True, 'tmpdir': tempfile.gettempdir()})
+        formats = {
+            'header': workbook.add_format(HEADER_FORMAT),
+            'date': workbook.add_format({'num_format': DATE_FORMAT}),
+            'datetime': workbook.add_format({'num_format': DATETIME_FORMAT}),
+        }
+        for name, frame in zip(sheets, frames):
+            sheet = workbook.add_worksheet(name)
+            sheet.write_row(0, 0, [str(col) for col in frame.columns], formats['header'])
+            columns = [_column_writer(frame[col], sheet, formats) for col in frame.columns]
+            writers = [writer for _, writer in columns]
+            for row, values in enumerate(zip(*[values for values, _ in columns]), start=1):
+                for col, (writer, value) in enumerate(zip(writers, values)):
+                    writer(row, col, value)
+        workbook.close()
+    return target
+
+def _write_sheet(frame, path, fmt):
+    if fmt == 'parquet':
+        if not HAS_PYARROW:
+            raise ImportError("Parquet export needs pyarrow: pip install pyarrow")
+        frame.to_parquet(path, index=False)
+    else:
+        frame.to_csv(path, index=False)
+    return path
+
+def write_sheets(frames, output_dir, fmt, name, sheets=SHEETS + [QUALITY_SHEET]):
+    # One file per service sheet, written concurrently
+    os.makedirs(output_dir, exist_ok=True)
+    paths = [os.path.join(output_dir, f"{name}_{sheet}.{fmt}") for sheet in sheets[:len(frames)]]
+    with stage(f"export_{fmt}", count_rows(frames)):
+        with ThreadPoolExecutor(max_workers=len(paths)) as pool:
+            return list(pool.map(_write_sheet, frames, paths, [fmt] * len(paths)))
+
+def write_zip(frames, path, fmt, name='dispatch_report'):
+    workdir = tempfile.mkdtemp(dir=os.path.dirname(path) or None)
+    try:
+        paths = write_sheets(frames, workdir, fmt, name)
+        # Parquet is compressed already
+        compression = zipfile.ZIP_STORED if fmt == 'parquet' else zipfile.ZIP_DEFLATED
+        with zipfile.ZipFile(path, 'w', compression=compression) as archive:
+            for sheet_path in paths:
+                archive.write(sheet_path, os.path.basename(sheet_path))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return path
+
+def export_report(frames, fmt, path):
+    # Writes to a temporary name first so a reader never sees a partial file
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        if fmt == 'xlsx':
+            write_xlsx(frames, tmp_path)
+        elif fmt in FORMATS:
+            write_zip(frames, tmp_path, fmt)
+        else:
+            raise ValueError(f"Unknown export format {fmt}")
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return path
+
+def export_path(fmt, key, export_dir=DEFAULT_EXPORT_DIR):
+    return os.path.join(export_dir, f"{key}_{fmt}.{FORMATS[fmt][0]}")
+
+def existing_export(fmt, key, export_dir=DEFAULT_EXPORT_DIR):
+    # The file an earlier export_file call rendered for this key, if still kept
+    path = export_path(fmt, key, export_dir)
+    return path if os.path.exists(path) else None
+
+def export_file(frames, fmt, key=None, export_dir=DEFAULT_EXPORT_DIR, max_bytes=DEFAULT_EXPORT_BYTES):
+    # Keyed exports are rendered once and reused; unkeyed ones get a fresh name
+    os.makedirs(export_dir, exist_ok=True)
+    path = export_path(fmt, key or uuid.uuid4().hex, export_dir)
+    if key and os.path.exists(path):
+        os.utime(path)
+        return path
+    export_report(frames, fmt, path)
+    _trim_exports(export_dir, max_bytes, keep=path)
+    return path
+
+def _trim_exports(export_dir, max_bytes, keep=None):
+    entries = []
+    for name in os.listdir(export_dir):
+        path = os.path.join(export_dir, name)
+        if name.endswith('.tmp') or path == keep or not os.path.isfile(path):
+            continue
+        entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+    total = sum(size for _, size, _ in entries) + (os.path.getsize(keep) if keep else 0)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
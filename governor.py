@@ -0,0 +1,193 @@
+import csv
+import os
+import struct
+import threading
+import zipfile
+from contextlib import contextmanager
+
+import pandas as pd
+
+from instrumentation import stage, rss_mb
+from schema import read_history, compression_for
+from streaming import CHUNK_OVERHEAD
+
+# Reports of every session share one process, so jobs are admitted against a
+# common memory budget: each one reserves its estimated footprint, and a job
+# that does not fit is moved to the streaming engine or waits for memory to
+# be released.
+MIN_BUDGET = 256 * 1024 * 1024
+MIN_STREAM_LIMIT = 64 * 1024 * 1024
+
+# A streamed job is not shrunk below the limit that reads its file in this
+# many chunks; smaller chunks only add per-chunk work
+MAX_STREAM_CHUNKS = 64
+
+SAMPLE_ROWS = 5_000
+
+# Typical size reduction of gzip/zstd/bz2/xz History exports, used when the
+# archive does not record the original size
+COMPRESSION_RATIO = 10
+
+# Peak memory of the in-memory engine relative to the parsed frame: parser
+# buffers while parsing, then the prepared copies and groupby temporaries
+MEMORY_OVERHEAD = 1.5
+
+# Peak memory of the chunked engines beyond their memory limit, relative to
+# the parsed frame: the merged per-item state and its merge copy when
+# streaming, the fetched result tables in SQL. Measured on the 1M-row
+# benchmark, where both stayed within these shares at 32 to 512 MB limits
+STATE_SHARE = {'streaming': 0.5, 'sql': 0.25}
+
+# The store parses one upload at a time and keeps the columns the quality
+# checks read of every upload, about a fifth of the parsed frame
+STORE_SCAN_SHARE = 0.2
+
+def memory_limit_bytes():
+    # The container's cgroup limit when there is one, else physical memory
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value.isdigit() and int(value) < 1 << 60:
+            return int(value)
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def default_budget():
+    if os.environ.get('DISPATCH_MEMORY_BUDGET_MB'):
+        return int(os.environ['DISPATCH_MEMORY_BUDGET_MB']) * 1024 * 1024
+    limit = memory_limit_bytes()
+    return max(MIN_BUDGET, int(limit * 0.8)) if limit else 4096 * 1024 * 1024
+
+def _rewind(source):
+    if hasattr(source, 'seek'):
+        source.seek(0)
+
+def uncompressed_size(source, compression=None):
+    if hasattr(source, 'seek'):
+        source.seek(0, os.SEEK_END)
+        size = source.tell()
+        source.seek(0)
+    else:
+        size = os.path.getsize(source)
+    if compression is None:
+        return size
+    if compression == 'zip':
+        with zipfile.ZipFile(source) as archive:
+            size = sum(info.file_size for info in archive.infolist())
+        _rewind(source)
+        return size
+    if compression == 'gzip' and not hasattr(source, 'seek') and size >= 4:
+        # The gzip trailer holds the original size modulo 4 GiB
+        with open(source, 'rb') as f:
+            f.seek(-4, os.SEEK_END)
+            original = struct.unpack('<I', f.read(4))[0]
+        if original >= size:
+            return original
+    return size * COMPRESSION_RATIO
+
+def estimate_frame_bytes(source):
+    # Rows are estimated from the mean line length of a sample, their parsed
+    # size from the same sample read with the report's column types
+    compression = compression_for(source)
+    size = uncompressed_size(source, compression)
+    lines = pd.read_csv(source, sep='\x1f', header=None, nrows=SAMPLE_ROWS + 1, quoting=csv.QUOTE_NONE,
+                        dtype=str, compression=compression, skip_blank_lines=True)
+    _rewind(source)
+    sample = read_history(source, nrows=SAMPLE_ROWS)
+    _rewind(source)
+    if len(sample) == 0:
+        return 0
+    line_bytes = lines[0].iloc[1:].str.len().mean() + 1
+    row_bytes = sample.memory_usage(deep=True).sum() / len(sample)
+    return int(size / line_bytes * row_bytes)
+
+def estimate_footprint(frame_bytes, engine, memory_limit, workers=1):
+    # frame_bytes holds the parsed size of each input file
+    if engine in STATE_SHARE:
+        return memory_limit + int(sum(frame_bytes) * STATE_SHARE[engine])
+    if engine == 'store':
+        return int(max(frame_bytes, default=0) * MEMORY_OVERHEAD + sum(frame_bytes) * STORE_SCAN_SHARE)
+    if engine == 'parallel':
+        # Workers hold one file each, the merged events are about their total
+        largest = sorted(frame_bytes, reverse=True)[:workers]
+        return int((sum(largest) + sum(frame_bytes)) * MEMORY_OVERHEAD / 2)
+    return int(sum(frame_bytes) * MEMORY_OVERHEAD)
+
+def min_stream_limit(frame_bytes):
+    # Chunks get half the limit and take CHUNK_OVERHEAD times their parsed size
+    return max(MIN_STREAM_LIMIT, int(sum(frame_bytes) * 2 * CHUNK_OVERHEAD / MAX_STREAM_CHUNKS))
+
+class MemoryGovernor:
+    # Process-wide admission control. The committed memory is the larger of
+    # the live RSS and the idle RSS plus every running job's reservation, so
+    # jobs that have not grown yet still count.
+
+    def __init__(self, budget=None):
+        self.budget = budget or default_budget()
+        self.base = self._rss()
+        self._reserved = {}
+        self._changed = threading.Condition()
+
+    def committed(self):
+        with self._changed:
+            return max(self._rss(), self.base + sum(self._reserved.values()))
+
+    def available(self):
+        return self.budget - self.committed()
+
+    def plan(self, frame_bytes, engine, memory_limit, workers=1, available=None):
+        # The cheapest change that fits: a single in-memory file is streamed,
+        # streamed files get smaller chunks down to MAX_STREAM_CHUNKS of them,
+        # several files use fewer workers. What still does not fit waits
+        available = self.available() if available is None else available
+        footprint = estimate_footprint(frame_bytes, engine, memory_limit, workers)
+        if footprint <= available:
+            return engine, memory_limit, workers, footprint
+        if engine == 'memory':
+            engine = 'streaming'
+        if engine == 'parallel':
+            while workers > 1 and estimate_footprint(frame_bytes, engine, memory_limit, workers) > available:
+                workers -= 1
+        elif engine in STATE_SHARE:
+            state = estimate_footprint(frame_bytes, engine, 0)
+            memory_limit = max(min_stream_limit(frame_bytes), min(memory_limit, available - state))
+        return engine, memory_limit, workers, estimate_footprint(frame_bytes, engine, memory_limit, workers)
+
+    @contextmanager
+    def admit(self, sources, engine, memory_limit, workers=1):
+        # Yields the (engine, memory_limit, workers) to run with once the job's
+        # footprint fits. A job alone in the process runs on its leanest plan,
+        # except a store job, which has none and is refused
+        with stage('admit', len(sources)) as record:
+            frame_bytes = [estimate_frame_bytes(source) for source in sources]
+            token = object()
+            with self._changed:
+                while True:
+                    plan = self.plan(frame_bytes, engine, memory_limit, workers)
+                    if plan[3] <= self.available():
+                        break
+                    if not self._reserved:
+                        if plan[0] == 'store':
+                            raise MemoryError(f"The upload needs about {plan[3] // (1024 * 1024):,} MB in the "
+                                              f"incremental store, more than the {self.available() // (1024 * 1024):,} "
+                                              f"MB of memory available; upload fewer files at a time")
+                        break
+                    # Woken when a job finishes; the timeout notices RSS drops
+                    self._changed.wait(timeout=1)
+                self._reserved[token] = plan[3]
+            record.update(engine=plan[0], reserved_mb=plan[3] / (1024 * 1024))
+        try:
+            yield plan[:3]
+        finally:
+            with self._changed:
+                del self._reserved[token]
+                self._changed.notify_all()
+
+    def _rss(self):
+        rss = rss_mb()
+        return 0 if rss != rss else int(rss * 1024 * 1024)
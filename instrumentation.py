@@ -0,0 +1,184 @@
+import contextvars
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Every pipeline stage runs inside stage(), which measures it and passes a
+# record to the hooks: hook('start', record) before the stage and
+# hook('end', record) once wall/CPU time, rows and memory are filled in.
+# Global hooks see every stage of the process; use_hooks() adds hooks for
+# the current context only, e.g. one Streamlit session.
+STAGE_LOG_PATH = os.environ.get('DISPATCH_STAGE_LOG')
+
+_hooks = []
+_scoped_hooks = contextvars.ContextVar('dispatch_stage_hooks', default=())
+_current = contextvars.ContextVar('dispatch_stage', default=None)
+_sequence = itertools.count()
+
+def rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return float('nan')
+    return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+# Peak RSS per stage: a sampler thread reads the RSS while any stage is open
+# and raises the peak of every open one. ru_maxrss would give the process's
+# lifetime high-water mark instead, the same for every stage of a long-lived
+# server once one large report has run.
+PEAK_SAMPLE_S = 0.02
+
+_watched = {}
+_watched_changed = threading.Condition()
+_sampler = []
+
+def _sample_peaks():
+    while True:
+        with _watched_changed:
+            while not _watched:
+                _watched_changed.wait()
+        rss = rss_mb()
+        with _watched_changed:
+            for record in _watched.values():
+                record['peak_rss_mb'] = max(record['peak_rss_mb'], rss)
+        time.sleep(PEAK_SAMPLE_S)
+
+def _watch_peak(record, rss):
+    with _watched_changed:
+        record['peak_rss_mb'] = rss
+        _watched[record['seq']] = record
+        if not _sampler:
+            _sampler.append(threading.Thread(target=_sample_peaks, name='dispatch-rss-sampler', daemon=True))
+            _sampler[0].start()
+        _watched_changed.notify()
+
+def _unwatch_peak(record, rss):
+    with _watched_changed:
+        del _watched[record['seq']]
+        record['peak_rss_mb'] = max(record['peak_rss_mb'], rss)
+
+def count_rows(value):
+    # Frames count their rows; tuples and dicts of frames count all of them
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (tuple, list)):
+        counts = [count_rows(item) for item in value]
+        return None if None in counts else sum(counts)
+    if hasattr(value, 'shape'):
+        return int(value.shape[0])
+    return None
+
+def add_hook(hook):
+    _hooks.append(hook)
+    return hook
+
+def remove_hook(hook):
+    if hook in _hooks:
+        _hooks.remove(hook)
+
+@contextmanager
+def use_hooks(*hooks):
+    token = _scoped_hooks.set(_scoped_hooks.get() + hooks)
+    try:
+        yield
+    finally:
+        _scoped_hooks.reset(token)
+
+def _emit(event, record):
+    for hook in list(_hooks) + list(_scoped_hooks.get()):
+        hook(event, record)
+
+@contextmanager
+def stage(name, rows_in=None):
+    parent = _current.get()
+    record = {
+        'seq': next(_sequence),
+        'run': parent['run'] if parent else uuid.uuid4().hex[:12],
+        'stage': name,
+        'path': f"{parent['path']}/{name}" if parent else name,
+        'depth': parent['depth'] + 1 if parent else 0,
+        'started_at': datetime.now(timezone.utc).isoformat(timespec='milliseconds'),
+        'rows_in': rows_in,
+        'rows_out': None,
+        'error': None,
+    }
+    token = _current.set(record)
+    start_rss = rss_mb()
+    _watch_peak(record, start_rss)
+    # CPU of this thread only: jobs and sessions share the process
+    start_wall, start_cpu = time.perf_counter(), time.thread_time()
+    _emit('start', record)
+    try:
+        yield record
+    except BaseException as e:
+        record['error'] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        end_rss = rss_mb()
+        _unwatch_peak(record, end_rss)
+        record.update(wall_s=time.perf_counter() - start_wall, cpu_s=time.thread_time() - start_cpu,
+                      rss_mb=end_rss, rss_delta_mb=end_rss - start_rss)
+        _current.reset(token)
+        _emit('end', record)
+
+def instrumented(name):
+    # Times a function as one stage; the first argument's rows are the rows in
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name, count_rows(args[0]) if args else None) as record:
+                result = function(*args, **kwargs)
+                record['rows_out'] = count_rows(result)
+                return result
+        return wrapper
+    return decorate
+
+class StageRecorder:
+    # Collects finished stages, e.g. for the CLI profile or the app's panel
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, event, record):
+        if event == 'end':
+            self.records.append(dict(record))
+
+class JsonLogHook:
+    # Appends one JSON object per finished stage to a log file or stream
+    def __init__(self, target):
+        self.target = target
+        self._lock = threading.Lock()
+
+    def __call__(self, event, record):
+        if event != 'end':
+            return
+        line = json.dumps(record, default=str) + '\n'
+        with self._lock:
+            if hasattr(self.target, 'write'):
+                self.target.write(line)
+                self.target.flush()
+            else:
+                with open(self.target, 'a') as f:
+                    f.write(line)
+
+def format_records(records):
+    lines = [f"{'stage':<24} {'wall s':>9} {'cpu s':>9} {'rows in':>11} {'rows out':>11} {'RSS MB':>9} "
+             f"{'delta MB':>9} {'peak MB':>9}"]
+    # Records finish innermost first; list them in the order they started
+    for r in sorted(records, key=lambda r: r['seq']):
+        name = '  ' * r['depth'] + r['stage']
+        lines.append(f"{name:<24} {r['wall_s']:9.3f} {r['cpu_s']:9.3f} {_blank(r['rows_in']):>11} "
+                     f"{_blank(r['rows_out']):>11} {r['rss_mb']:9.1f} {r['rss_delta_mb']:9.1f} {r['peak_rss_mb']:9.1f}")
+    return '\n'.join(lines)
+
+def _blank(value):
+    return '' if value is None else value
+
+if STAGE_LOG_PATH:
+    add_hook(JsonLogHook(STAGE_LOG_PATH))
@@ -0,0 +1,135 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from instrumentation import use_hooks, StageRecorder
+
+# Reports run on a small thread pool instead of the Streamlit script thread.
+# Each job keeps its spooled uploads, a status file and, once finished, the
+# report frames in its own directory, so a browser that
+# reconnects can pick the job up again by its id.
+DEFAULT_JOB_DIR = os.environ.get('DISPATCH_JOB_DIR') or os.path.join(tempfile.gettempdir(), 'dispatch_jobs')
+DEFAULT_JOB_WORKERS = int(os.environ.get('DISPATCH_JOB_WORKERS', '2'))
+DEFAULT_JOB_TTL = float(os.environ.get('DISPATCH_JOB_TTL_HOURS', '24')) * 3600
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+RESULT_FILE = 'result.pkl'
+
+class JobQueue:
+    # Jobs are identified by the caller, normally by their report key, so a
+    # second submission of the same work joins the queued or finished job
+    # instead of running it again.
+
+    def __init__(self, job_dir=DEFAULT_JOB_DIR, workers=DEFAULT_JOB_WORKERS, ttl=DEFAULT_JOB_TTL):
+        self.job_dir = job_dir
+        self.ttl = ttl
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='dispatch-job')
+        self._lock = threading.Lock()
+        self._active = {}
+        os.makedirs(job_dir, exist_ok=True)
+
+    def submit(self, job_id, uploads, compute, **info):
+        # uploads are binary files, spooled to disk so the job outlives the
+        # session; compute(paths) returns the report frames
+        with self._lock:
+            current = self.status(job_id)
+            if current and current['state'] != FAILED:
+                return job_id
+            shutil.rmtree(self._path(job_id), ignore_errors=True)
+            paths = self._spool(job_id, uploads)
+            status = dict(info, id=job_id, state=QUEUED, stage=None, error=None, submitted_at=time.time(),
+                          finished_at=None, stages=[])
+            self._active[job_id] = status
+            self._save(status)
+            self._pool.submit(self._run, status, compute, paths)
+        self._trim()
+        return job_id
+
+    def status(self, job_id):
+        # None for unknown jobs; jobs left unfinished by an earlier process fail
+        if not job_id.isalnum():
+            return None
+        status = self._active.get(job_id)
+        if status is not None:
+            return dict(status)
+        try:
+            with open(self._path(job_id, 'status.json')) as f:
+                status = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if status['state'] in (QUEUED, RUNNING):
+            status.update(state=FAILED, error="The server restarted before the job finished")
+        return status
+
+    def result(self, job_id):
+        os.utime(self._path(job_id, 'status.json'))
+        return pd.read_pickle(self._path(job_id, RESULT_FILE))
+
+    def _run(self, status, compute, paths):
+        recorder = StageRecorder()
+
+        def progress(event, record):
+            if event == 'start':
+                status['stage'] = record['path']
+            elif record['depth'] <= 1:
+                status['stages'] = list(recorder.records)
+                self._save(status)
+
+        status.update(state=RUNNING, started_at=time.time())
+        self._save(status)
+        try:
+            with use_hooks(recorder, progress):
+                frames = compute(paths)
+            pd.to_pickle(tuple(frames), self._path(status['id'], RESULT_FILE))
+            status.update(state=DONE)
+        except Exception as e:
+            status.update(state=FAILED, error=str(e))
+        finally:
+            shutil.rmtree(self._path(status['id'], 'uploads'), ignore_errors=True)
+            status.update(stage=None, stages=recorder.records, finished_at=time.time())
+            self._save(status)
+            with self._lock:
+                self._active.pop(status['id'], None)
+
+    def _spool(self, job_id, uploads):
+        upload_dir = self._path(job_id, 'uploads')
+        os.makedirs(upload_dir)
+        paths = []
+        for index, upload in enumerate(uploads):
+            path = os.path.join(upload_dir, f"{index}_{os.path.basename(getattr(upload, 'name', 'upload.csv'))}")
+            upload.seek(0)
+            with open(path, 'wb') as f:
+                shutil.copyfileobj(upload, f, 1024 * 1024)
+            upload.seek(0)
+            paths.append(path)
+        return paths
+
+    def _save(self, status):
+        path = self._path(status['id'], 'status.json')
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(status, f, default=str)
+        os.replace(tmp_path, path)
+
+    def _trim(self):
+        # Finished jobs are kept for the TTL after their last use
+        cutoff = time.time() - self.ttl
+        for name in os.listdir(self.job_dir):
+            path = os.path.join(self.job_dir, name)
+            if name in self._active or not os.path.isdir(path):
+                continue
+            try:
+                if os.path.getmtime(os.path.join(path, 'status.json')) < cutoff:
+                    shutil.rmtree(path, ignore_errors=True)
+            except FileNotFoundError:
+                pass
+
+    def _path(self, job_id, *parts):
+        return os.path.join(self.job_dir, job_id, *parts)
@@ -0,0 +1,74 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import stage, instrumented
+from data_processor import EVENT_COLUMNS, prepare_scans, route_partials, merge_partials, build_report
+from schema import read_history
+from validation import quality_checks
+
+DEFAULT_WORKERS = int(os.environ.get('DISPATCH_WORKERS', '0')) or os.cpu_count() or 1
+
+# Workers start from a clean process instead of a fork of this one: report
+# jobs and the RSS sampler run on threads, and a lock one of them holds at the
+# moment of a fork would stay held forever in the child
+MP_CONTEXT = multiprocessing.get_context(
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+# A scan is identified across files by its event columns; rows without a
+# readable time, kept for the quality checks, also by the text that failed
+DEDUP_COLUMNS = EVENT_COLUMNS + ['Unparsed_Scan_Time']
+
+def prepare_events(source):
+    # The prepared scans of one export, undated ones included for the quality checks
+    return prepare_scans(read_history(source))[DEDUP_COLUMNS + ['Updated_Status']]
+
+def drop_cross_file_duplicates(frames_by_file, columns=DEDUP_COLUMNS):
+    # A scan repeated by an overlapping export only counts in the first file
+    # that has it; repeats inside one export are kept as in a single-file run
+    frames = pd.concat(frames_by_file, ignore_index=True)
+    file_index = np.repeat(np.arange(len(frames_by_file)), [len(frame) for frame in frames_by_file])
+    row_hash = pd.util.hash_pandas_object(frames[columns], index=False).to_numpy()
+    first_file = pd.Series(file_index).groupby(row_hash).transform('min').to_numpy()
+    return frames[file_index == first_file]
+
+def _map(function, items, workers):
+    if workers <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+    with ProcessPoolExecutor(max_workers=min(workers, len(items)), mp_context=MP_CONTEXT) as pool:
+        return list(pool.map(function, items))
+
+@instrumented('process')
+def process_dispatch_files(sources, workers=DEFAULT_WORKERS, quality=None):
+    # Paths are parsed in worker processes; open buffers are parsed here.
+    # quality, when a list, receives the row-quality checks of the scans left
+    # after dropping the overlap between files
+    paths = [source for source in sources if isinstance(source, (str, os.PathLike))]
+    with stage('prepare_files') as record:
+        parsed = dict(zip(paths, _map(prepare_events, paths, workers)))
+        scans_by_file = [parsed[source] if isinstance(source, (str, os.PathLike)) else prepare_events(source)
+                         for source in sources]
+        del parsed
+        record['rows_out'] = sum(len(scans) for scans in scans_by_file)
+    if not scans_by_file:
+        raise ValueError("No History files to process")
+    with stage('deduplicate', record['rows_out']) as record:
+        scans = drop_cross_file_duplicates(scans_by_file)
+        del scans_by_file
+        if quality is not None:
+            quality.append(quality_checks(scans))
+        events = scans.loc[scans['Date'].notna(), EVENT_COLUMNS + ['Updated_Status']]
+        del scans
+        record['rows_out'] = len(events)
+
+    # Every report metric is local to one Date, so dates are aggregated independently
+    date_frames = [frame for _, frame in events.groupby('Date', sort=True)]
+    if not date_frames:
+        raise ValueError("The History files contain no scans with a date")
+    del events
+    with stage('partials_by_date', record['rows_out']):
+        partials = _map(route_partials, date_frames, workers)
+    return build_report(merge_partials(partials))
@@ -0,0 +1,88 @@
+from data_processor import (REPORT_VERSION, PARTIAL_NAMES, clean_scans, classify_scans, route_partials, route_metrics,
+                            apply_rates, finish_report, lifecycle_kpis)
+from dispatch_rules import get_rules, STATUS_SECTIONS, SERVICE_SECTIONS, RATE_SECTIONS
+from instrumentation import stage, count_rows
+from result_cache import cache_key
+from validation import quality_report
+
+# The in-memory report as a chain of named stages. Each stage's key is a
+# fingerprint of its inputs' keys and of the rules sections it reads, so a
+# cached intermediate is reused until something it depends on changes: a
+# rate-card edit reruns 'rates' and 'report', a status remap reruns from
+# 'status' on, and the cleaned scans are kept across every rules edit.
+class Stage:
+    def __init__(self, name, inputs, compute, sections=(), cache=True):
+        self.name = name
+        self.inputs = inputs
+        self.compute = compute
+        self.sections = sections
+        self.cache = cache
+
+def _partials(scans, status):
+    # A shallow copy takes the status column without touching the cached scans
+    scans = scans.copy(deep=False)
+    scans['Updated_Status'] = status['Updated_Status']
+    partials = route_partials(scans)
+    return tuple(partials[name] for name in PARTIAL_NAMES)
+
+STAGES = [
+    Stage('clean', ['source'], lambda rules, df: clean_scans(df)),
+    Stage('status', ['clean'], lambda rules, scans: classify_scans(scans, rules).to_frame(), STATUS_SECTIONS),
+    # The cache stores tuples of frames; partials travel in PARTIAL_NAMES order
+    Stage('partials', ['clean', 'status'], lambda rules, scans, status: _partials(scans, status)),
+    Stage('routes', ['partials'], lambda rules, partials: route_metrics(dict(zip(PARTIAL_NAMES, partials)), rules),
+          SERVICE_SECTIONS),
+    Stage('rates', ['routes'], lambda rules, routes: apply_rates(routes, rules), RATE_SECTIONS),
+    Stage('report', ['rates'], lambda rules, routes: finish_report(routes), cache=False),
+    # Off the report's path; resolved with 'report' so they share the cleaned scans and partials
+    Stage('lifecycle', ['partials'], lambda rules, partials: lifecycle_kpis(dict(zip(PARTIAL_NAMES, partials)))),
+    Stage('quality', ['clean'], lambda rules, scans: quality_report(scans, rules), STATUS_SECTIONS + SERVICE_SECTIONS),
+]
+
+class Pipeline:
+    def __init__(self, cache, stages=STAGES):
+        self.cache = cache
+        self.stages = {stage.name: stage for stage in stages}
+
+    def keys(self, source_key, rules=None):
+        # Stage name -> cache key, for one source and one version of the rules
+        rules = rules or get_rules()
+        keys = {'source': source_key}
+        for name, node in self.stages.items():
+            keys[name] = cache_key(name, REPORT_VERSION, [keys[input] for input in node.inputs],
+                                   rules.fingerprint(*node.sections) if node.sections else None)
+        return keys
+
+    def run(self, source_key, load_source, target='report'):
+        # target is a stage name, or a list of names resolved in one pass that
+        # shares the stages they have in common; load_source() is only called
+        # when no cached stage downstream of it is usable
+        with stage('process'):
+            return self._run(source_key, load_source, target)
+
+    def _run(self, source_key, load_source, target):
+        rules = get_rules()
+        keys = self.keys(source_key, rules)
+        results = {}
+
+        def resolve(name):
+            if name in results:
+                return results[name]
+            if name == 'source':
+                results[name] = load_source()
+                return results[name]
+            node = self.stages[name]
+            value = self.cache.get(keys[name]) if node.cache else None
+            if value is None:
+                inputs = [resolve(input) for input in node.inputs]
+                with stage(name, count_rows(inputs[0])) as record:
+                    value = node.compute(rules, *inputs)
+                    record['rows_out'] = count_rows(value)
+                if node.cache:
+                    self.cache.put(keys[name], value)
+            results[name] = value
+            return value
+
+        if isinstance(target, str):
+            return resolve(target)
+        return [resolve(name) for name in target]
@@ -0,0 +1,182 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+DEFAULT_CACHE_BYTES = int(os.environ.get('DISPATCH_CACHE_MB', '1024')) * 1024 * 1024
+DEFAULT_CACHE_DIR = os.environ.get('DISPATCH_CACHE_DIR') or None
+DEFAULT_DISK_BYTES = int(os.environ.get('DISPATCH_CACHE_DISK_MB', '8192')) * 1024 * 1024
+
+def content_hash(data, chunk_size=1024 * 1024):
+    # Accepts bytes or a seekable binary file; files are hashed in chunks
+    digest = hashlib.sha256()
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        digest.update(data)
+    else:
+        position = data.tell()
+        data.seek(0)
+        for chunk in iter(lambda: data.read(chunk_size), b''):
+            digest.update(chunk)
+        data.seek(position)
+    return digest.hexdigest()
+
+def cache_key(*parts):
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+def value_nbytes(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        return sum(value_nbytes(item) for item in value)
+    raise TypeError(f"Cannot cache values of type {type(value).__name__}")
+
+class ResultCache:
+    # LRU cache for parsed uploads, report frames and rendered exports, bounded
+    # by an estimate of their resident size. With a directory set, entries are
+    # also written to disk as Arrow IPC files and memory-mapped back on a miss.
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES, disk_dir=DEFAULT_CACHE_DIR, disk_max_bytes=DEFAULT_DISK_BYTES):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir if HAS_PYARROW else None
+        self.disk_max_bytes = disk_max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self._key_locks = {}
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries or (self.disk_dir is not None and os.path.isdir(self._disk_path(key)))
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+        value = self._load(key)
+        if value is None:
+            return default
+        self._remember(key, value)
+        return value
+
+    def put(self, key, value):
+        self._remember(key, value)
+        if self.disk_dir:
+            self._store(key, value)
+        return value
+
+    def get_or_compute(self, key, compute):
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        # One computation per key; concurrent callers wait for its result
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            value = self.get(key)
+            if value is None:
+                value = self.put(key, compute())
+        with self._lock:
+            self._key_locks.pop(key, None)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+        if self.disk_dir:
+            shutil.rmtree(self.disk_dir, ignore_errors=True)
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def _remember(self, key, value):
+        nbytes = value_nbytes(value)
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.nbytes -= evicted
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key)
+
+    def _store(self, key, value):
+        path = self._disk_path(key)
+        tmp_path = path + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        if isinstance(value, (tuple, list)):
+            kind, parts = 'tuple', list(value)
+        else:
+            kind, parts = 'single', [value]
+        for index, part in enumerate(parts):
+            if isinstance(part, pd.DataFrame):
+                table = pa.Table.from_pandas(part, preserve_index=True)
+                with pa.OSFile(os.path.join(tmp_path, f"{index}.arrow"), 'wb') as sink:
+                    with pa.ipc.new_file(sink, table.schema) as writer:
+                        writer.write_table(table)
+            else:
+                with open(os.path.join(tmp_path, f"{index}.bin"), 'wb') as f:
+                    f.write(part)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({'kind': kind, 'parts': len(parts)}, f)
+
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        self._trim_disk()
+
+    def _load(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(os.path.join(path, 'meta.json')) as f:
+                meta = json.load(f)
+            parts = []
+            for index in range(meta['parts']):
+                arrow_path = os.path.join(path, f"{index}.arrow")
+                if os.path.exists(arrow_path):
+                    with pa.memory_map(arrow_path) as source:
+                        parts.append(pa.ipc.open_file(source).read_all().to_pandas())
+                else:
+                    with open(os.path.join(path, f"{index}.bin"), 'rb') as f:
+                        parts.append(f.read())
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+        return tuple(parts) if meta['kind'] == 'tuple' else parts[0]
+
+    def _trim_disk(self):
+        entries = []
+        for name in os.listdir(self.disk_dir):
+            path = os.path.join(self.disk_dir, name)
+            if name.endswith('.tmp') or not os.path.isdir(path):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.disk_max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
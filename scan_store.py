@@ -0,0 +1,140 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from data_processor import EVENT_COLUMNS, PARTIAL_NAMES, prepare_scans, route_partials, merge_partials, build_report
+from instrumentation import stage
+from dispatch_rules import get_rules, STATUS_SECTIONS
+from parallel import DEDUP_COLUMNS, drop_cross_file_duplicates
+from schema import HAS_PYARROW, read_parquet
+from validation import quality_checks
+
+DEFAULT_STORE_DIR = os.environ.get('DISPATCH_STORE_DIR', 'dispatch_store')
+
+# Bumped whenever route_partials changes shape or result, so stored partials are rebuilt
+PARTIALS_VERSION = 7
+
+def prepare_events(df):
+    return _dated_events(prepare_scans(df))
+
+def _dated_events(df_selected):
+    return df_selected[EVENT_COLUMNS].dropna(subset=['Date'])
+
+class ScanStore:
+    # Date-partitioned Parquet store of deduplicated scan events plus the route
+    # partials computed from them. Overlapping exports only rewrite the dates
+    # that gained new scans; services and rates are applied at report time.
+
+    def __init__(self, root=DEFAULT_STORE_DIR):
+        if not HAS_PYARROW:
+            raise ImportError("The incremental store needs pyarrow: pip install pyarrow")
+        self.root = root
+        os.makedirs(os.path.join(root, 'events'), exist_ok=True)
+        os.makedirs(os.path.join(root, 'partials'), exist_ok=True)
+        self._check_rules()
+
+    def dates(self):
+        names = os.listdir(os.path.join(self.root, 'events'))
+        return sorted(pd.Timestamp(name.split('=', 1)[1]) for name in names if name.startswith('Date='))
+
+    def ingest(self, df):
+        return self.ingest_events(prepare_events(df))
+
+    def ingest_events(self, events):
+        with stage('ingest', len(events)):
+            return self._ingest_events(events)
+
+    def _ingest_events(self, events):
+        changed = []
+        for date, new_events in events.groupby('Date', sort=True):
+            existing = self.read_events(date)
+            if existing is None:
+                combined = new_events.drop_duplicates()
+            else:
+                combined = pd.concat([existing, new_events], ignore_index=True).drop_duplicates()
+                if len(combined) == len(existing):
+                    continue
+            self._write(combined, self._path('events', date, 'events'))
+            self._write_partials(date, combined)
+            changed.append(date)
+        return changed
+
+    def read_events(self, date):
+        events = self._read(self._path('events', date, 'events'))
+        if events is not None and events['Item_ID'].dtype != object:
+            # Events stored before Item_ID was read as text
+            item_ids = events['Item_ID']
+            if pd.api.types.is_float_dtype(item_ids) and (item_ids.dropna() % 1 == 0).all():
+                item_ids = item_ids.astype('Int64')
+            events['Item_ID'] = item_ids.astype(str).where(item_ids.notna(), np.nan)
+        return events
+
+    def read_partials(self, date):
+        return {name: self._read(self._path('partials', date, name)) for name in PARTIAL_NAMES}
+
+    def report(self, dates=None, start=None, end=None):
+        dates = self.dates() if dates is None else sorted(pd.Timestamp(date) for date in dates)
+        dates = [date for date in dates
+                 if (start is None or date >= pd.Timestamp(start)) and (end is None or date <= pd.Timestamp(end))]
+        partials = [self.read_partials(date) for date in dates]
+        partials = [p for p in partials if p['routes'] is not None]
+        if not partials:
+            raise ValueError("No stored scans for the requested dates")
+        return build_report(merge_partials(partials))
+
+    def ingest_and_report(self, frames, quality=None):
+        # Report every date of the uploads, completed with earlier exports of
+        # those days. quality, when a list, receives the row-quality checks of
+        # the uploads, a scan shared by several of them counted once
+        with stage('process'):
+            dates = set()
+            scans_by_file = []
+            for df in frames:
+                df_selected = prepare_scans(df)
+                if quality is not None:
+                    scans_by_file.append(df_selected[DEDUP_COLUMNS])
+                events = _dated_events(df_selected)
+                del df_selected
+                self.ingest_events(events)
+                dates.update(events['Date'].unique())
+            if quality is not None and scans_by_file:
+                quality.append(quality_checks(drop_cross_file_duplicates(scans_by_file)))
+            return self.report(dates=dates)
+
+    def _write_partials(self, date, events):
+        events = events.copy()
+        events['Updated_Status'] = get_rules().categorize_statuses(events['Status'])
+        for name, frame in route_partials(events).items():
+            self._write(frame, self._path('partials', date, name))
+
+    def _check_rules(self):
+        # Status remaps and new partial layouts change every stored partial,
+        # so rebuild them from the events
+        manifest_path = os.path.join(self.root, 'manifest.json')
+        expected = {'status_rules': get_rules().fingerprint(*STATUS_SECTIONS), 'partials_version': PARTIALS_VERSION}
+        manifest = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        if manifest == expected:
+            return
+        for date in self.dates():
+            self._write_partials(date, self.read_events(date))
+        with open(manifest_path, 'w') as f:
+            json.dump(expected, f)
+
+    def _path(self, kind, date, name):
+        return os.path.join(self.root, kind, f"Date={pd.Timestamp(date):%Y-%m-%d}", f"{name}.parquet")
+
+    def _write(self, frame, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        frame.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+
+    def _read(self, path):
+        if not os.path.exists(path):
+            return None
+        return read_parquet(path)
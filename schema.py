@@ -0,0 +1,166 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import stage
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+try:
+    import zstandard  # noqa: F401
+    HAS_ZSTANDARD = True
+except ImportError:
+    HAS_ZSTANDARD = False
+
+# Columns of the History export used by the report, after normalisation
+SCAN_TIME_COLUMN = 'ScanCode_DateTime_(MM/DD/YYYY_HH:mm:ss)'
+
+SELECTED_COLUMNS = ['Item_ID', 'Bill_To_Account_Number', 'Tracking_Number', 'Service',
+                    SCAN_TIME_COLUMN, 'Status', 'Status_Description',
+                    'Route_Code', 'Ship_To_Name', 'Ship_To_Address', 'Ship_To_Address_2',
+                    'Ship_To_City', 'Ship_To_State/Province', 'Ship_To_Postal_Code/ZIP',
+                    'Ship_To_Country', 'Delivery_Driver_Name', 'Delivery_Address',
+                    'Delivery_City', 'Delivery_Province', 'Delivery_Postal_Code/ZIP',
+                    'Delivery_Country', 'Latitude', 'Longitude', 'Client_Name']
+
+# Low-cardinality columns parsed straight into categoricals
+CATEGORICAL_COLUMNS = ['Status', 'Route_Code', 'Delivery_Driver_Name', 'Service', 'Client_Name',
+                       'Ship_To_State/Province', 'Ship_To_Country', 'Delivery_Province', 'Delivery_Country']
+
+# Identifiers, postal codes and address parts are text even when an export's
+# values look numeric; inferred per chunk or per file, 123 and '123' would be
+# different items, and a unit number 12 read as 12.0 once a chunk has a blank
+# would be a different address
+STRING_COLUMNS = ['Item_ID', 'Bill_To_Account_Number', 'Tracking_Number', 'Ship_To_Name', 'Ship_To_Address',
+                  'Ship_To_Address_2', 'Ship_To_City', 'Ship_To_Postal_Code/ZIP', 'Delivery_City',
+                  'Delivery_Postal_Code/ZIP']
+
+RENAMED_COLUMNS = {SCAN_TIME_COLUMN: 'Scan_Date'}
+
+# Scan timestamps are always exported as MM/DD/YYYY HH:mm:ss
+SCAN_TIME_FORMAT = '%m/%d/%Y %H:%M:%S'
+
+# History exports may arrive compressed; the codec follows the file extension
+COMPRESSION_EXTENSIONS = {'.gz': 'gzip', '.zst': 'zstd', '.zip': 'zip', '.bz2': 'bz2', '.xz': 'xz'}
+
+# Extensions that can be read here; zstd needs the optional zstandard package
+READABLE_EXTENSIONS = [extension for extension, codec in COMPRESSION_EXTENSIONS.items()
+                       if codec != 'zstd' or HAS_ZSTANDARD]
+
+class SchemaError(ValueError):
+    pass
+
+def normalize_column(name):
+    return name.replace(' ', '_')
+
+def normalize_columns(df):
+    df.columns = df.columns.str.replace(' ', '_')
+    return df
+
+def compression_for(source):
+    # Paths and named uploads alike
+    name = source if isinstance(source, (str, os.PathLike)) else getattr(source, 'name', None)
+    if not name:
+        return None
+    compression = COMPRESSION_EXTENSIONS.get(os.path.splitext(str(name))[1].lower())
+    if compression == 'zstd' and not HAS_ZSTANDARD:
+        raise ImportError(f"{name} is zstd compressed, which needs zstandard: pip install zstandard")
+    return compression
+
+def read_header(source, compression=None):
+    header = pd.read_csv(source, nrows=0, compression=compression).columns.tolist()
+    if hasattr(source, 'seek'):
+        source.seek(0)
+    return header
+
+def check_columns(columns):
+    # Fails on a header without every column the report reads, before any rows are parsed
+    present = {normalize_column(str(name)) for name in columns}
+    missing = [name for name in SELECTED_COLUMNS if name not in present]
+    if missing:
+        raise SchemaError(f"The History export is missing {len(missing)} of the {len(SELECTED_COLUMNS)} columns "
+                          f"the report needs: {', '.join(missing)}")
+
+def read_options(header):
+    check_columns(header)
+    # Project and type the raw header names, whatever spacing the export used
+    usecols = [name for name in header if normalize_column(name) in SELECTED_COLUMNS]
+    dtype = {name: 'category' for name in usecols if normalize_column(name) in CATEGORICAL_COLUMNS}
+    dtype.update({name: str for name in usecols if normalize_column(name) in STRING_COLUMNS})
+    return {'usecols': usecols, 'dtype': dtype}
+
+# Codecs pyarrow decompresses itself; zip and xz exports go through the C parser
+ARROW_COMPRESSION = [None, 'gzip', 'bz2', 'zstd']
+
+def read_history(source, chunksize=None, **kwargs):
+    compression = compression_for(source)
+    options = read_options(read_header(source, compression))
+
+    # pyarrow parses in parallel but cannot stream or stop early
+    if chunksize is None and not kwargs and HAS_PYARROW and compression in ARROW_COMPRESSION:
+        with stage('parse') as record:
+            df = _read_arrow(source, compression, **options)
+            record['rows_out'] = len(df)
+        return normalize_columns(df)
+
+    options['compression'] = compression
+    options.update(kwargs)
+    # The C parser maps plain files on disk instead of copying them through a read buffer
+    if compression is None and isinstance(source, (str, os.PathLike)):
+        options.setdefault('memory_map', True)
+
+    if chunksize is not None:
+        reader = pd.read_csv(source, chunksize=chunksize, **options)
+        return _NormalizingReader(reader)
+    with stage('parse') as record:
+        df = pd.read_csv(source, **options)
+        record['rows_out'] = len(df)
+    return normalize_columns(df)
+
+def _read_arrow(source, compression, usecols, dtype):
+    # Typed columns are declared to pyarrow as text up front: pandas' pyarrow
+    # engine only casts after inferring, which turns a unit number 12 into
+    # '12.0' in a file where the column has a blank. Categoricals are built
+    # from the text afterwards, as the C parser does
+    convert_options = pa_csv.ConvertOptions(
+        include_columns=usecols, column_types={name: pa.string() for name in dtype},
+        # pandas also reads these as missing
+        null_values=pa_csv.ConvertOptions().null_values + ['<NA>', 'None'], strings_can_be_null=True)
+    with pa.input_stream(source, compression=compression) as stream:
+        table = pa_csv.read_csv(stream, convert_options=convert_options)
+    # All-blank columns come back untyped; pandas reads them as float
+    table = table.cast(pa.schema([field.with_type(pa.float64()) if pa.types.is_null(field.type) else field
+                                  for field in table.schema]))
+    df = _missing_as_nan(table.to_pandas())
+    return df.astype({name: kind for name, kind in dtype.items() if kind == 'category'})
+
+def read_parquet(path):
+    return _missing_as_nan(pd.read_parquet(path))
+
+def _missing_as_nan(df):
+    # Arrow hands back missing strings as None where the C parser uses NaN
+    text = df.select_dtypes(object).columns
+    df[text] = df[text].where(df[text].notna(), np.nan)
+    return df
+
+class _NormalizingReader:
+    def __init__(self, reader):
+        self.reader = reader
+
+    def get_chunk(self, size=None):
+        return normalize_columns(self.reader.get_chunk(size))
+
+    def __iter__(self):
+        return (normalize_columns(chunk) for chunk in self.reader)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.reader.close()
@@ -0,0 +1,315 @@
+import math
+import os
+import shutil
+import sqlite3
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from data_processor import RESULT_COLUMNS, EARTH_RADIUS_KM, prepare_scans, display_times, split_services
+from dispatch_rules import get_rules
+from instrumentation import stage, instrumented
+from streaming import iter_chunks, DEFAULT_MEMORY_LIMIT
+from validation import quality_checks
+
+try:
+    import duckdb
+    HAS_DUCKDB = True
+except ImportError:
+    HAS_DUCKDB = False
+
+SQL_BACKENDS = ['auto', 'duckdb', 'sqlite']
+
+# Prepared scans are loaded chunk by chunk into an on-disk database and the
+# report is computed there, so only one chunk and the route-level result are
+# ever held in pandas. Dates are stored as days and timestamps as seconds
+# since the epoch, which both backends compare and sort the same way.
+SCAN_TABLE_COLUMNS = ['Seq', 'Item_ID', 'Date', 'Scan_Time', 'Time', 'Status', 'Route_Code',
+                      'Delivery_Driver_Name', 'Delivery_City', 'Address_Key', 'Latitude', 'Longitude']
+
+KEYS = 'Date, Delivery_Driver_Name, Route_Code'
+
+def _literal(value):
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return repr(float(value))
+
+def _in_list(values):
+    return ', '.join(_literal(value) for value in values)
+
+def status_case(rules, column='Status'):
+    # The first category listing a code wins, as in DispatchRules
+    cases = [f"WHEN {column} IN ({_in_list(codes)}) THEN {_literal(category)}"
+             for category, codes in rules.config['statuses'].items() if codes]
+    return f"CASE {' '.join(cases)} ELSE {_literal(rules.default_status)} END"
+
+def service_case(rules, column='Route_Code'):
+    # substr keeps the prefix match case-sensitive; SQLite's LIKE is not
+    cases = [f"WHEN substr({column}, 1, {len(prefix)}) = {_literal(prefix)} THEN {_literal(service)}"
+             for prefix, service in rules.service_prefixes]
+    return f"CASE {' '.join(cases)} ELSE {_literal(rules.default_service)} END"
+
+def rate_case(rules, service='Service', city='Delivery_City'):
+    # The first matching override wins, as in DispatchRules
+    cases = [f"WHEN {service} = {_literal(override['service'])} AND {city} IN ({_in_list(override['cities'])}) "
+             f"THEN {_literal(override['rate'])}" for override in rules.rate_overrides]
+    cases += [f"WHEN {service} = {_literal(name)} THEN {_literal(rate)}" for name, rate in rules.rates.items()]
+    return f"CASE {' '.join(cases)} ELSE {_literal(rules.default_rate)} END"
+
+def scan_rows(df_selected, first_seq):
+    # The prepared columns the report needs, in table layout; rows without a
+    # scan date never reach a route
+    scans = df_selected[df_selected['Date'].notna()]
+    return pd.DataFrame({
+        'Seq': np.arange(first_seq, first_seq + len(scans), dtype=np.int64),
+        'Item_ID': scans['Item_ID'].to_numpy(),
+        'Date': (scans['Date'].to_numpy().astype('datetime64[D]').astype(np.int64)),
+        'Scan_Time': scans['Scan_Date'].to_numpy().astype('datetime64[s]').astype(np.int64),
+        'Time': scans['Time'].to_numpy(dtype=np.int64),
+        'Status': scans['Status'].astype(object).to_numpy(),
+        'Route_Code': scans['Route_Code'].astype(object).to_numpy(),
+        'Delivery_Driver_Name': scans['Delivery_Driver_Name'].astype(object).to_numpy(),
+        'Delivery_City': scans['Delivery_City'].astype(object).to_numpy(),
+        'Address_Key': scans['Ship_To_Address_Key'].to_numpy().view(np.int64),
+        'Latitude': pd.to_numeric(scans['Latitude'], errors='coerce').to_numpy(dtype=float),
+        'Longitude': pd.to_numeric(scans['Longitude'], errors='coerce').to_numpy(dtype=float),
+    })
+
+class _DuckDBBackend:
+    def __init__(self, path, memory_limit, temp_dir):
+        self.connection = duckdb.connect(path)
+        # DuckDB spills joins, sorts and aggregations past the limit to temp_dir
+        self.connection.execute(f"SET memory_limit = '{max(memory_limit // (1024 * 1024), 64)}MB'")
+        self.connection.execute(f"SET temp_directory = {_literal(temp_dir)}")
+        self.connection.execute("SET preserve_insertion_order = false")
+        self.loaded = False
+
+    def load(self, rows):
+        self.connection.register('chunk', rows)
+        if self.loaded:
+            self.connection.execute("INSERT INTO raw_scans SELECT * FROM chunk")
+        else:
+            self.connection.execute("CREATE TABLE raw_scans AS SELECT * FROM chunk")
+            self.loaded = True
+        self.connection.unregister('chunk')
+
+    def execute(self, sql):
+        self.connection.execute(sql)
+
+    def query(self, sql):
+        return self.connection.execute(sql).df()
+
+    def close(self):
+        self.connection.close()
+
+# SQLite builds without the math functions get Python ones for the distances
+SQLITE_MATH = {'radians': (1, math.radians), 'sin': (1, math.sin), 'cos': (1, math.cos),
+               'asin': (1, math.asin), 'sqrt': (1, math.sqrt), 'power': (2, math.pow)}
+
+class _SQLiteBackend:
+    def __init__(self, path, memory_limit, temp_dir):
+        self.connection = sqlite3.connect(path)
+        try:
+            self.connection.execute("SELECT asin(sqrt(power(sin(radians(1)), 2)))")
+        except sqlite3.OperationalError:
+            for name, (arguments, function) in SQLITE_MATH.items():
+                self.connection.create_function(name, arguments, function, deterministic=True)
+        # Page cache within the limit; temp b-trees for sorts go to disk
+        self.connection.execute(f"PRAGMA cache_size = -{max(memory_limit // 1024 // 2, 2048)}")
+        self.connection.execute("PRAGMA temp_store = FILE")
+        self.connection.execute("PRAGMA journal_mode = OFF")
+        self.connection.execute("PRAGMA synchronous = OFF")
+        self.loaded = False
+
+    def load(self, rows):
+        if not self.loaded:
+            self.connection.execute(
+                "CREATE TABLE raw_scans (Seq INTEGER, Item_ID, Date INTEGER, Scan_Time INTEGER, Time INTEGER, "
+                "Status TEXT, Route_Code TEXT, Delivery_Driver_Name TEXT, Delivery_City TEXT, Address_Key INTEGER, "
+                "Latitude REAL, Longitude REAL)")
+            self.loaded = True
+        values = rows.astype(object).where(rows.notna(), None)
+        placeholders = ', '.join('?' * len(SCAN_TABLE_COLUMNS))
+        self.connection.executemany(f"INSERT INTO raw_scans VALUES ({placeholders})",
+                                    values.itertuples(index=False, name=None))
+        self.connection.commit()
+
+    def execute(self, sql):
+        self.connection.execute(sql)
+
+    def query(self, sql):
+        return pd.read_sql_query(sql, self.connection)
+
+    def close(self):
+        self.connection.close()
+
+def resolve_backend(backend):
+    if backend == 'auto':
+        return 'duckdb' if HAS_DUCKDB else 'sqlite'
+    if backend == 'duckdb' and not HAS_DUCKDB:
+        raise ImportError("The DuckDB backend needs duckdb: pip install duckdb")
+    if backend not in SQL_BACKENDS:
+        raise ValueError(f"Unknown SQL backend {backend}")
+    return backend
+
+def haversine_sql(latitude1, longitude1, latitude2, longitude2):
+    return (f"2 * {EARTH_RADIUS_KM} * asin(sqrt(power(sin(radians({latitude2} - {latitude1}) / 2), 2) + "
+            f"cos(radians({latitude1})) * cos(radians({latitude2})) * "
+            f"power(sin(radians({longitude2} - {longitude1}) / 2), 2)))")
+
+def _report_queries(rules):
+    located = "Item_ID IS NOT NULL AND Route_Code IS NOT NULL AND Delivery_Driver_Name IS NOT NULL"
+    routed = "Route_Code IS NOT NULL AND Delivery_Driver_Name IS NOT NULL"
+    return {
+        'scans': f"""
+            CREATE TABLE scans AS
+            SELECT *, {status_case(rules)} AS Updated_Status FROM raw_scans""",
+
+        # The latest located OFD and delivered scan of each item and day, the
+        # later row on equal timestamps, as in the item timeline
+        'latest': f"""
+            CREATE TABLE latest AS
+            SELECT Item_ID, Date, Updated_Status, Route_Code, Delivery_Driver_Name FROM (
+                SELECT Item_ID, Date, Updated_Status, Route_Code, Delivery_Driver_Name,
+                       ROW_NUMBER() OVER (PARTITION BY Item_ID, Date, Updated_Status
+                                          ORDER BY Scan_Time DESC, Seq DESC) AS rn
+                FROM scans
+                WHERE Updated_Status IN ('OFD Scans', 'Delivered') AND {located}
+            ) AS ranked WHERE rn = 1""",
+
+        'mismatch_routes': """
+            CREATE TABLE mismatch_routes AS
+            SELECT o.Date, o.Delivery_Driver_Name, o.Route_Code, d.Route_Code AS Delivered_Route,
+                   COUNT(*) AS Items
+            FROM latest AS o JOIN latest AS d ON d.Item_ID = o.Item_ID AND d.Date = o.Date
+            WHERE o.Updated_Status = 'OFD Scans' AND d.Updated_Status = 'Delivered'
+              AND o.Route_Code <> d.Route_Code AND o.Delivery_Driver_Name = d.Delivery_Driver_Name
+            GROUP BY o.Date, o.Delivery_Driver_Name, o.Route_Code, d.Route_Code""",
+
+        'report': f"""
+            WITH routes AS (
+                SELECT {KEYS},
+                       COUNT(DISTINCT CASE WHEN Updated_Status = 'OFD Scans' THEN Item_ID END) AS Number_of_Packages,
+                       COUNT(DISTINCT Address_Key) AS Number_of_Stops,
+                       MIN(Time) AS Start_Time,
+                       MAX(Time) AS End_Time,
+                       COUNT(DISTINCT CASE WHEN Updated_Status = 'Delivered' THEN Item_ID END) AS Delivered_No
+                FROM scans WHERE {routed}
+                GROUP BY {KEYS}
+                HAVING SUM(CASE WHEN Updated_Status = 'OFD Scans' THEN 1 ELSE 0 END) > 0
+            ),
+            cities AS (
+                SELECT {KEYS}, Delivery_City FROM (
+                    SELECT {KEYS}, Delivery_City,
+                           ROW_NUMBER() OVER (PARTITION BY {KEYS} ORDER BY Seq) AS rn
+                    FROM scans WHERE {routed} AND Delivery_City IS NOT NULL
+                ) AS ranked WHERE rn = 1
+            ),
+            mismatches AS (
+                SELECT {KEYS}, SUM(Items) AS Mismatch_Count FROM mismatch_routes GROUP BY {KEYS}
+            ),
+            returns AS (
+                SELECT {KEYS}, COUNT(*) AS Confirmed_Return FROM (
+                    SELECT {KEYS}, Item_ID FROM scans
+                    WHERE Updated_Status IN ('Delivered', 'Return') AND {located}
+                    GROUP BY {KEYS}, Item_ID
+                    HAVING SUM(CASE WHEN Updated_Status = 'Delivered' THEN 1 ELSE 0 END) = 0
+                ) AS returned GROUP BY {KEYS}
+            ),
+            stops AS (
+                SELECT DISTINCT {KEYS}, Scan_Time, Latitude, Longitude FROM scans
+                WHERE Updated_Status = 'Delivered' AND {routed}
+                  AND Latitude BETWEEN -90 AND 90 AND Longitude BETWEEN -180 AND 180
+                  AND NOT (Latitude = 0 AND Longitude = 0)
+            ),
+            legs AS (
+                SELECT {KEYS}, Latitude, Longitude,
+                       LAG(Latitude) OVER route_order AS Previous_Latitude,
+                       LAG(Longitude) OVER route_order AS Previous_Longitude
+                FROM stops
+                WINDOW route_order AS (PARTITION BY {KEYS} ORDER BY Scan_Time, Latitude, Longitude)
+            ),
+            distances AS (
+                SELECT {KEYS},
+                       SUM(CASE WHEN Previous_Latitude IS NULL THEN 0.0
+                                ELSE {haversine_sql('Previous_Latitude', 'Previous_Longitude', 'Latitude', 'Longitude')}
+                           END) AS Distance_km
+                FROM legs GROUP BY {KEYS}
+            ),
+            joined AS (
+                SELECT routes.*, cities.Delivery_City, {service_case(rules, 'routes.Route_Code')} AS Service,
+                       COALESCE(mismatches.Mismatch_Count, 0) AS Mismatch_Count,
+                       COALESCE(returns.Confirmed_Return, 0) AS Confirmed_Return,
+                       COALESCE(distances.Distance_km, 0.0) AS Distance_km
+                FROM routes
+                LEFT JOIN cities USING (Date, Delivery_Driver_Name, Route_Code)
+                LEFT JOIN mismatches USING (Date, Delivery_Driver_Name, Route_Code)
+                LEFT JOIN returns USING (Date, Delivery_Driver_Name, Route_Code)
+                LEFT JOIN distances USING (Date, Delivery_Driver_Name, Route_Code)
+            )
+            SELECT *, {rate_case(rules)} AS Rates,
+                   (Delivered_No + Mismatch_Count) * {rate_case(rules)} AS Amount_to_be_paid,
+                   Number_of_Packages / CASE WHEN Distance_km > 0 THEN Distance_km END AS Packages_per_km,
+                   Delivered_No / CASE WHEN End_Time > Start_Time THEN (End_Time - Start_Time) / 3600.0 END
+                       AS Deliveries_per_hour
+            FROM joined ORDER BY {KEYS}""",
+
+        'mismatch_names': f"SELECT {KEYS}, Delivered_Route FROM mismatch_routes ORDER BY Delivered_Route",
+    }
+
+def _result_frame(report, names):
+    # Attach the delivery route names and give columns the in-memory engine's types
+    names = names.groupby(['Date', 'Delivery_Driver_Name', 'Route_Code'])['Delivered_Route'].agg(', '.join)
+    report = report.join(names.rename('Mismatch_Route'), on=['Date', 'Delivery_Driver_Name', 'Route_Code'])
+    report['Mismatch_Route'] = report['Mismatch_Route'].astype(object)
+    report['Date'] = pd.to_datetime(report['Date'].to_numpy(dtype=np.int64), unit='D').date
+    report['Start_Time'] = display_times(report['Start_Time'])
+    report['End_Time'] = display_times(report['End_Time'])
+    report['Delivery_City'] = report['Delivery_City'].astype(object).where(report['Delivery_City'].notna(), np.nan)
+    for column in ['Number_of_Packages', 'Number_of_Stops', 'Delivered_No', 'Mismatch_Count', 'Confirmed_Return']:
+        report[column] = report[column].astype(np.int64)
+    for column in ['Rates', 'Amount_to_be_paid', 'Distance_km', 'Packages_per_km', 'Deliveries_per_hour']:
+        report[column] = report[column].astype(float)
+    return report[RESULT_COLUMNS]
+
+@instrumented('process')
+def process_dispatch_sql(source, backend='auto', memory_limit=DEFAULT_MEMORY_LIMIT, database=None, quality=None):
+    # database keeps the loaded scans in that file; by default a temp file is used and removed.
+    # quality, when a list, receives the row-quality checks of every chunk
+    backend = resolve_backend(backend)
+    workdir = tempfile.mkdtemp(prefix='dispatch_sql_')
+    path = database or os.path.join(workdir, f"scans.{backend}")
+    if os.path.exists(path):
+        os.remove(path)
+    connection_class = _DuckDBBackend if backend == 'duckdb' else _SQLiteBackend
+    connection = connection_class(path, memory_limit, workdir)
+    try:
+        rules = get_rules()
+        with stage('load') as record:
+            loaded = 0
+            for chunk in iter_chunks(source, memory_limit):
+                df_selected = prepare_scans(chunk)
+                if quality is not None:
+                    quality.append(quality_checks(df_selected, rules))
+                rows = scan_rows(df_selected, loaded)
+                if len(rows):
+                    connection.load(rows)
+                    loaded += len(rows)
+            record['rows_out'] = loaded
+        if not loaded:
+            raise ValueError("The uploaded file contains no scans with a date")
+
+        queries = _report_queries(rules)
+        with stage('query', loaded) as record:
+            connection.execute(queries['scans'])
+            connection.execute("DROP TABLE raw_scans")
+            for name in ['latest', 'mismatch_routes']:
+                connection.execute(queries[name])
+            report = connection.query(queries['report'])
+            names = connection.query(queries['mismatch_names'])
+            record['rows_out'] = len(report)
+        return split_services(_result_frame(report, names))
+    finally:
+        connection.close()
+        shutil.rmtree(workdir, ignore_errors=True)
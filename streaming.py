@@ -0,0 +1,77 @@
+import os
+
+from instrumentation import stage, instrumented
+from schema import read_history
+from data_processor import prepare_scans, route_partials, merge_partials, partials_nbytes, build_report
+from validation import quality_checks
+
+# Memory for one streamed report, split between the chunk being processed
+# and the chunk partials waiting to be merged. The merged state grows with
+# the distinct items of the file and is not bounded by it.
+DEFAULT_MEMORY_LIMIT = int(os.environ.get('DISPATCH_MEMORY_LIMIT_MB', '512')) * 1024 * 1024
+
+SAMPLE_ROWS = 10_000
+MIN_CHUNK_ROWS = 1_000
+
+# A prepared chunk holds the raw columns, the cleaned copies and the groupby
+# temporaries at the same time.
+CHUNK_OVERHEAD = 4
+
+def chunk_rows_for(sample, memory_limit):
+    bytes_per_row = max(sample.memory_usage(deep=True).sum() / max(len(sample), 1), 1)
+    return max(MIN_CHUNK_ROWS, int(memory_limit / 2 / (bytes_per_row * CHUNK_OVERHEAD)))
+
+def _read_chunk(reader, size=None):
+    # None once the reader is exhausted
+    with stage('parse') as record:
+        try:
+            chunk = reader.get_chunk(size)
+        except StopIteration:
+            return None
+        record['rows_out'] = len(chunk)
+    return chunk
+
+def iter_chunks(source, memory_limit=DEFAULT_MEMORY_LIMIT):
+    # A small first chunk sizes the rest to fit the memory limit
+    reader = read_history(source, chunksize=SAMPLE_ROWS)
+    with reader:
+        chunk = _read_chunk(reader)
+        if chunk is None:
+            return
+        chunk_rows = chunk_rows_for(chunk, memory_limit)
+        while chunk is not None:
+            yield chunk
+            chunk = _read_chunk(reader, chunk_rows)
+
+def iter_partials(source, memory_limit=DEFAULT_MEMORY_LIMIT, quality=None):
+    # quality, when a list, receives the row-quality checks of every chunk
+    for chunk in iter_chunks(source, memory_limit):
+        with stage('chunk', len(chunk)):
+            df_selected = prepare_scans(chunk)
+            if quality is not None:
+                quality.append(quality_checks(df_selected))
+            partials = route_partials(df_selected)
+        yield partials
+
+@instrumented('stream')
+def stream_partials(source, memory_limit=DEFAULT_MEMORY_LIMIT, quality=None):
+    pending = []
+    merged_bytes = new_bytes = 0
+    for partials in iter_partials(source, memory_limit, quality):
+        pending.append(partials)
+        new_bytes += partials_nbytes(partials)
+
+        # Fold the chunks added since the last merge into the state once they
+        # outgrow their share and the state itself, so a state that grows with
+        # the items of the file is merged at geometric intervals, not per chunk
+        if new_bytes > max(memory_limit / 2, merged_bytes) and len(pending) > 1:
+            pending = [merge_partials(pending)]
+            merged_bytes, new_bytes = partials_nbytes(pending[0]), 0
+
+    if not pending:
+        raise ValueError("The uploaded file contains no rows")
+    return merge_partials(pending)
+
+@instrumented('process')
+def process_dispatch_file(source, memory_limit=DEFAULT_MEMORY_LIMIT, quality=None):
+    return build_report(stream_partials(source, memory_limit, quality))
@@ -1,54 +1,262 @@
 import streamlit as st
 import pandas as pd
-import io
+from data_processor import REPORT_VERSION
+from dispatch_rules import get_rules
+from exports import export_file, existing_export, FORMATS
+from governor import MemoryGovernor
+from jobs import JobQueue, QUEUED, RUNNING, DONE, FAILED
+from result_cache import ResultCache, content_hash, cache_key
+from schema import read_history, READABLE_EXTENSIONS
+from streaming import process_dispatch_file, DEFAULT_MEMORY_LIMIT
+from scan_store import ScanStore
+from sql_engine import process_dispatch_sql
+from parallel import process_dispatch_files, DEFAULT_WORKERS
+from pipeline import Pipeline
+from validation import quality_frame, merge_checks
+import os
+import threading
+import uuid
 from datetime import datetime
-from data_processor import process_dispatch_data, create_excel_report
+
+@st.cache_resource
+def get_result_cache():
+    # Shared by every session of this server process
+    return ResultCache()
+
+ENGINE_LABELS = {'memory': "In memory", 'streaming': "Low-memory streaming", 'sql': "Embedded SQL"}
+
+# Compressed exports are spooled as they are and decompressed while parsing;
+# zstd is only offered when zstandard is installed
+UPLOAD_TYPES = ['csv'] + [extension.lstrip('.') for extension in READABLE_EXTENSIONS]
+
+FORMAT_LABELS = {'xlsx': "Excel workbook", 'csv': "CSV files (zip)", 'parquet': "Parquet files (zip)"}
+
+STAGE_COLUMNS = ['path', 'wall_s', 'cpu_s', 'rows_in', 'rows_out', 'rss_delta_mb', 'peak_rss_mb']
+
+@st.cache_resource
+def get_job_queue():
+    # Jobs outlive the sessions that submitted them
+    return JobQueue()
+
+@st.cache_resource
+def get_memory_governor():
+    # One memory budget for the jobs of every session
+    return MemoryGovernor()
+
+@st.cache_resource
+def get_store_lock():
+    # Incremental jobs write to the same store, so they run one at a time
+    return threading.Lock()
+
+def stage_line(record):
+    rows = '' if record['rows_out'] is None else f", {record['rows_out']:,} rows"
+    return f"{record['path']}: {record['wall_s']:.2f}s{rows}"
+
+@st.fragment(run_every=1)
+def job_progress(job_id):
+    # Polls the job while it runs; the whole page reruns once it is finished
+    status = get_job_queue().status(job_id)
+    if status is None or status['state'] in (DONE, FAILED):
+        st.rerun()
+    if status['state'] == QUEUED:
+        label = "Waiting for a free worker..."
+    elif status['stage'] == 'admit':
+        label = "Waiting for memory..."
+    elif status['stage']:
+        label = f"Processing: {status['stage'].replace('/', ' › ')}"
+    else:
+        label = "Processing..."
+    with st.status(label, state='running'):
+        for record in sorted(status['stages'], key=lambda r: r['seq']):
+            st.write(stage_line(record))
+
+def show_stage_panel(records):
+    st.sidebar.subheader("Stage timings")
+    if not records:
+        st.sidebar.caption("The last report came from the cache.")
+        return
+    stages = pd.DataFrame(records).sort_values('seq')
+    st.sidebar.dataframe(stages[STAGE_COLUMNS], hide_index=True)
+
+def show_report(job_id, frames):
+    next_day_df, same_day_df, montreal_df = frames[:3]
+
+    # Show preview tabs
+    st.subheader("Report Preview")
+    tab1, tab2, tab3 = st.tabs(["Next Day", "Same Day", "Montreal"])
+    with tab1:
+        st.dataframe(next_day_df)
+    with tab2:
+        st.dataframe(same_day_df)
+    with tab3:
+        st.dataframe(montreal_df)
+
+    # Show metrics
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("Next Day Deliveries", len(next_day_df))
+    with col2:
+        st.metric("Same Day Deliveries", len(same_day_df))
+    with col3:
+        st.metric("Montreal Deliveries", len(montreal_df))
+
+    # Rows the report could not use as intended; a report the CLI left in the
+    # shared cache comes without them
+    if len(frames) > 3:
+        quality = frames[3]
+        flagged = int(quality['Rows'].sum())
+        with st.expander(f"Data quality: {flagged:,} flagged rows" if flagged else "Data quality: no issues found"):
+            st.dataframe(quality, hide_index=True)
+    else:
+        st.caption("No data quality report was built for this report.")
+
+    # Every format, the workbook included, is only rendered on request, on
+    # disk, and reused for the same report, also by a reconnected page
+    fmt = st.selectbox("Download format", list(FORMATS), format_func=FORMAT_LABELS.get)
+    exports = st.session_state.setdefault('exports', {})
+    path = exports.get((job_id, fmt)) or existing_export(fmt, job_id)
+    if not (path and os.path.exists(path)) and st.button("Prepare download"):
+        with st.spinner(f"Writing {FORMAT_LABELS[fmt].lower()}..."):
+            path = exports[(job_id, fmt)] = export_file(frames, fmt, key=job_id)
+
+    if path and os.path.exists(path):
+        extension, mime = FORMATS[fmt]
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        with open(path, 'rb') as f:
+            st.download_button(
+                "Download Report",
+                data=f,
+                file_name=f"dispatch_report_{timestamp}.{extension}",
+                mime=mime
+            )
 
 def main():
     st.title("Ecom Dispatch Report")
-    st.write("Upload your CSV file (up to 500MB) and get a formatted Excel report.")
+    st.write(f"Upload your CSV file (up to 500MB, or compressed as {', '.join(UPLOAD_TYPES[1:])}) "
+             "and get a formatted Excel report.")
+
+    engine = st.sidebar.radio("Engine", list(ENGINE_LABELS), format_func=ENGINE_LABELS.get,
+                              help="Streaming reads the file in chunks; embedded SQL aggregates it in DuckDB or SQLite, "
+                                   "spilling to disk instead of loading it whole")
+    streaming = engine != 'memory'
+    memory_limit_mb = st.sidebar.number_input("Memory limit (MB)", min_value=64,
+                                              value=DEFAULT_MEMORY_LIMIT // (1024 * 1024), step=64,
+                                              disabled=not streaming,
+                                              help="Sizes the chunks read at a time; the merged totals grow with "
+                                                   "the items in the file and can exceed it")
+    # Only offered with the in-memory engine and off with the others: a disabled
+    # checkbox keeps its last value and would send the job to the store anyway
+    incremental = not streaming and st.sidebar.checkbox(
+        "Incremental store", help="Only process scans not seen in earlier uploads of the same days")
 
-    uploaded_file = st.file_uploader("Choose a CSV file", type="csv")
+    workers = st.sidebar.number_input("Worker processes", min_value=1, value=DEFAULT_WORKERS,
+                                      help="Used when several History files are uploaded together")
+    show_stages = st.sidebar.checkbox("Show stage timings", help="Time, rows and memory of each pipeline stage")
 
-    if uploaded_file:
+    uploaded_files = st.file_uploader("Choose CSV files", type=UPLOAD_TYPES, accept_multiple_files=True)
+
+    cache = get_result_cache()
+    jobs = get_job_queue()
+    report_key = file_hash = None
+
+    if uploaded_files:
         try:
-            df = pd.read_csv(uploaded_file)
-            st.dataframe(df.head())
+            # Hash each upload once; reruns of the same upload reuse the digest
+            hashes = st.session_state.setdefault('upload_hashes', {})
+            for upload in uploaded_files:
+                if upload.file_id not in hashes:
+                    hashes[upload.file_id] = content_hash(upload)
+            file_hashes = [hashes[upload.file_id] for upload in uploaded_files]
+            file_hash = file_hashes[0] if len(file_hashes) == 1 else cache_key(*file_hashes)
+            uploaded_file = uploaded_files[0]
+            multiple = len(uploaded_files) > 1
+            if multiple and streaming:
+                st.info(f"Several files are processed in parallel; the {ENGINE_LABELS[engine].lower()} engine applies to single files.")
+
+            st.dataframe(read_history(uploaded_file, nrows=5))
+            uploaded_file.seek(0)
+            memory_limit = memory_limit_mb * 1024 * 1024
+
+            requested = 'store' if incremental else 'parallel' if multiple else engine
+
+            # Runs on the job queue with the uploads spooled to these paths,
+            # once the memory governor admits it, possibly on a leaner engine
+            def generate_report(paths):
+                with get_memory_governor().admit(paths, requested, memory_limit, workers) as plan:
+                    job_engine, job_memory_limit, job_workers = plan
+                    if job_engine == 'memory' and not (incremental or multiple):
+                        # Stages unaffected by a rules edit come from the cache; the
+                        # row-quality report reads the scans the report just cleaned
+                        frames, quality = Pipeline(cache).run(file_hash, lambda: read_history(paths[0]),
+                                                              ['report', 'quality'])
+                        return tuple(frames) + (quality,)
+                    # The other engines check each chunk or file as they prepare it
+                    checks = []
+                    if incremental:
+                        with get_store_lock():
+                            frames = ScanStore().ingest_and_report((read_history(path) for path in paths), checks)
+                    elif multiple:
+                        frames = process_dispatch_files(paths, workers=job_workers, quality=checks)
+                    elif job_engine == 'sql':
+                        frames = process_dispatch_sql(paths[0], memory_limit=job_memory_limit, quality=checks)
+                    else:
+                        frames = process_dispatch_file(paths[0], memory_limit=job_memory_limit, quality=checks)
+                    return tuple(frames) + (quality_frame(merge_checks(checks)),)
+
+            # Every engine produces the same report, so they share a key, which
+            # is also the job id: identical requests join one job. Incremental
+            # reports depend on the store as well and get a job of their own.
+            report_key = (None if incremental
+                          else cache_key(file_hash, 'report', REPORT_VERSION, get_rules().fingerprint()))
+
+            def run_job(paths):
+                if report_key is None:
+                    return generate_report(paths)
+                # The report key holds the three service sheets, shared with the
+                # CLI; the quality frame of an earlier run is kept next to them
+                quality_key = cache_key(report_key, 'quality')
+                frames = cache.get(report_key)
+                if frames is None:
+                    frames = generate_report(paths)
+                    cache.put(report_key, tuple(frames[:3]))
+                    cache.put(quality_key, frames[3])
+                    return frames
+                quality = cache.get(quality_key)
+                return frames if quality is None else tuple(frames) + (quality,)
 
             if st.button("Generate Dispatch Report"):
-                with st.spinner('Processing...'):
-                    next_day_df, same_day_df, montreal_df = process_dispatch_data(df)
-
-                    # Show preview tabs
-                    st.subheader("Report Preview")
-                    tab1, tab2, tab3 = st.tabs(["Next Day", "Same Day", "Montreal"])
-                    with tab1:
-                        st.dataframe(next_day_df)
-                    with tab2:
-                        st.dataframe(same_day_df)
-                    with tab3:
-                        st.dataframe(montreal_df)
-
-                    # Show metrics
-                    col1, col2, col3 = st.columns(3)
-                    with col1:
-                        st.metric("Next Day Deliveries", len(next_day_df))
-                    with col2:
-                        st.metric("Same Day Deliveries", len(same_day_df))
-                    with col3:
-                        st.metric("Montreal Deliveries", len(montreal_df))
-
-                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                    st.download_button(
-                        "Download Report",
-                        data=create_excel_report(next_day_df, same_day_df, montreal_df).getvalue(),
-                        file_name=f"dispatch_report_{timestamp}.xlsx",
-                        mime="application/vnd.ms-excel"
-                    )
-                    st.success("Report generated successfully!")
+                job_id = jobs.submit(report_key or uuid.uuid4().hex, uploaded_files, run_job,
+                                     file_hash=file_hash, engine=requested)
+                # Kept in the URL so a refreshed or reopened page finds the job again
+                st.query_params['job'] = job_id
 
         except Exception as e:
             st.error(f"Error: {str(e)}")
 
+    job_id = st.query_params.get('job')
+    status = jobs.status(job_id) if job_id else None
+    # A new upload hides the job of an earlier one until it is generated
+    if status is None or (uploaded_files and job_id != report_key and status.get('file_hash') != file_hash):
+        return
+
+    if status['state'] in (QUEUED, RUNNING):
+        job_progress(job_id)
+        return
+    if show_stages:
+        show_stage_panel(status['stages'])
+    if status['state'] == FAILED:
+        st.error(f"Error: {status['error']}")
+        return
+    admitted = [record.get('engine') for record in status['stages'] if record['stage'] == 'admit']
+    if admitted and admitted[0] != status.get('engine') and admitted[0] in ENGINE_LABELS:
+        st.info(f"Memory was short, so this report was built by the {ENGINE_LABELS[admitted[0]].lower()} engine.")
+
+    try:
+        # The job id is also the report key, which holds the service sheets
+        # only; the job's result may carry the quality frame as well
+        show_report(job_id, cache.get_or_compute(cache_key(job_id, 'job'), lambda: jobs.result(job_id)))
+    except Exception as e:
+        st.error(f"Error: {str(e)}")
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
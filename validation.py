@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+
+from dispatch_rules import get_rules
+
+# Row-level checks on the cleaned scans. Each check classifies the distinct
+# values of one column once and counts rows through the category codes, so
+# the report costs a few bincounts rather than another pass over the text.
+BLANK = '(blank)'
+EXAMPLES = 5
+
+def _value_counts(values, flagged):
+    # (value, rows) for every value, blank included, that flagged() accepts
+    if not isinstance(values.dtype, pd.CategoricalDtype):
+        values = values.astype('category')
+    categories = values.cat.categories
+    counts = np.bincount(values.cat.codes.to_numpy() + 1, minlength=len(categories) + 1)
+    found = [(BLANK, counts[0])] if counts[0] and flagged(np.nan) else []
+    found += [(value, count) for value, count in zip(categories, counts[1:]) if count and flagged(value)]
+    return found
+
+def quality_checks(df_selected, rules=None):
+    rules = rules or get_rules()
+    unparsed = df_selected['Unparsed_Scan_Time']
+    missing_time = df_selected['Scan_Date'].isna() & unparsed.isna()
+    return [
+        ('Unreadable scan time', _value_counts(unparsed, pd.notna)),
+        ('Missing scan time', [(BLANK, int(missing_time.sum()))] if missing_time.any() else []),
+        ('Unknown status', _value_counts(df_selected['Status'], lambda status: status not in rules.status_map)),
+        ('Route without a service prefix', _value_counts(
+            df_selected['Route_Code'], lambda route: rules.service_of(route) == rules.default_service)),
+        ('Missing driver name', _value_counts(df_selected['Delivery_Driver_Name'], pd.isna)),
+    ]
+
+def merge_checks(parts):
+    # quality_checks of the chunks or files of one report, counts summed per value
+    merged = {}
+    for checks in parts:
+        for check, found in checks:
+            counts = merged.setdefault(check, {})
+            for value, count in found:
+                counts[value] = counts.get(value, 0) + count
+    return [(check, list(counts.items())) for check, counts in merged.items()]
+
+def quality_frame(checks):
+    # One row per check with its row count and the most frequent offending values
+    rows = []
+    for check, found in checks:
+        found = sorted(found, key=lambda item: (-item[1], str(item[0])))
+        examples = ', '.join(f"{value} ({count:,})" for value, count in found[:EXAMPLES])
+        rows.append({'Check': check, 'Rows': int(sum(count for _, count in found)), 'Examples': examples})
+    return pd.DataFrame(rows, columns=['Check', 'Rows', 'Examples'])
+
+def quality_report(df_selected, rules=None):
+    return quality_frame(quality_checks(df_selected, rules))